@@ -0,0 +1,137 @@
+"""Broadcast backplanes for ConnectionManager.
+
+Every broadcast is published to a backplane, and local fan-out only happens
+when the event comes back from it. The in-memory backplane (default) just
+hands events straight back to this process. The pub/sub backplane sends them
+over a Redis-compatible channel so that every uvicorn worker and node sees
+every message, typing event and join/leave notice.
+"""
+
+import asyncio
+import os
+from dotenv import load_dotenv
+
+from app.core.serializer import encode, decode
+from app.core.metrics import ERRORS
+
+# Load environment variables from .env file
+load_dotenv()
+
+BROADCAST_BACKEND = os.getenv("BROADCAST_BACKEND", "memory")  # memory | redis
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+BROADCAST_CHANNEL = os.getenv("BROADCAST_CHANNEL", "chat:events")
+
+
+def pack(payload: str, **meta) -> str:
+    """Wrap an already encoded payload with routing metadata for the bus.
+
+    The payload is appended verbatim after a one-line header so it is never
+    serialized twice.
+    """
+    return encode(meta) + "\n" + payload
+
+
+def unpack(raw: str | bytes) -> tuple[dict, str]:
+    """Split a bus event into (metadata, payload)."""
+    if isinstance(raw, bytes):
+        raw = raw.decode()
+    header, _, payload = raw.partition("\n")
+    return decode(header), payload
+
+
+class Backplane:
+    """Interface between ConnectionManager and the transport carrying broadcasts."""
+
+    def __init__(self):
+        self._handler = None
+
+    async def start(self, handler):
+        """Begin delivering received events to `handler(raw)`."""
+        self._handler = handler
+
+    async def publish(self, raw: str):
+        raise NotImplementedError
+
+    async def stop(self):
+        self._handler = None
+
+
+class MemoryBackplane(Backplane):
+    """Single-process backplane: published events are delivered straight back."""
+
+    async def publish(self, raw: str):
+        if self._handler is not None:
+            await self._handler(raw)
+
+
+class PubSubBackplane(Backplane):
+    """Backplane over a Redis-compatible pub/sub channel.
+
+    `client` is a `redis.asyncio.Redis` instance or anything exposing the same
+    `publish`/`pubsub` API (e.g. fakeredis for tests).
+    """
+
+    def __init__(self, client, channel: str = BROADCAST_CHANNEL):
+        super().__init__()
+        self.client = client
+        self.channel = channel
+        self._pubsub = None
+        self._reader: asyncio.Task | None = None
+
+    async def start(self, handler):
+        await super().start(handler)
+        self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(self.channel)
+        self._reader = asyncio.create_task(self._read())
+
+    async def publish(self, raw: str):
+        await self.client.publish(self.channel, raw)
+
+    async def _read(self):
+        while True:
+            try:
+                async for message in self._pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    try:
+                        await self._handler(message["data"])
+                    except Exception:
+                        ERRORS.inc("backplane_event")  # A bad event must not kill the subscription
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Connection to the broker dropped; resubscribe after a short pause
+                ERRORS.inc("backplane_read")
+                await asyncio.sleep(1)
+                try:
+                    await self._pubsub.subscribe(self.channel)
+                except Exception:
+                    ERRORS.inc("backplane_subscribe")
+
+    async def stop(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+        if self._pubsub is not None:
+            try:
+                await self._pubsub.unsubscribe(self.channel)
+                await self._pubsub.aclose()
+            except Exception:
+                pass
+            self._pubsub = None
+        await super().stop()
+
+
+def create_backplane() -> Backplane:
+    """Build the backplane selected by BROADCAST_BACKEND."""
+    if BROADCAST_BACKEND == "memory":
+        return MemoryBackplane()
+    if BROADCAST_BACKEND == "redis":
+        import redis.asyncio as redis  # Optional dependency: pip install redis
+
+        return PubSubBackplane(redis.from_url(REDIS_URL))
+    raise ValueError("BROADCAST_BACKEND must be one of memory, redis")
@@ -0,0 +1,127 @@
+"""Content-addressed blob store for chat images.
+
+Each image is written once under MEDIA_DIR, named by the SHA-256 of its bytes
+plus an extension derived from the sniffed image type, so identical uploads
+share a single file. Messages keep only the blob URL (`/media/<name>`).
+Derived variants (thumbnails) are stored next to the original as
+`<digest>_<variant>.<ext>`.
+"""
+
+import base64
+import binascii
+import hashlib
+import os
+import re
+import tempfile
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+MEDIA_DIR = os.getenv("MEDIA_DIR", "./media")
+MEDIA_URL_PREFIX = "/media/"
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(5 * 1024 * 1024)))  # 5MB
+
+# Extension -> content type for the image formats we accept
+IMAGE_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "gif": "image/gif",
+    "webp": "image/webp",
+}
+
+_NAME_RE = re.compile(r"^([0-9a-f]{64})(?:_([a-z]+))?\.(png|jpg|gif|webp)$")
+
+
+def sniff_image_type(data: bytes) -> str | None:
+    """Return the file extension for known image signatures, None otherwise."""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return "gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def parse_name(name: str) -> tuple[str, str | None, str] | None:
+    """Split a blob name into (digest, variant, extension), or None if it is not valid."""
+    match = _NAME_RE.match(name)
+    if not match:
+        return None
+    return match.group(1), match.group(2), match.group(3)
+
+
+def variant_name(name: str, variant: str, ext: str) -> str:
+    """Name of a derived variant of the blob `name`."""
+    return f"{name.partition('.')[0]}_{variant}.{ext}"
+
+
+def blob_path(name: str) -> str:
+    """Filesystem path of a blob. Sharded by the first two hex digits of the digest."""
+    return os.path.join(MEDIA_DIR, name[:2], name)
+
+
+def blob_url(name: str) -> str:
+    return MEDIA_URL_PREFIX + name
+
+
+def name_from_url(url: str) -> str | None:
+    """Return the blob name for a `/media/...` URL that exists in the store."""
+    if not url.startswith(MEDIA_URL_PREFIX):
+        return None
+    name = url[len(MEDIA_URL_PREFIX):]
+    if parse_name(name) is None or not os.path.exists(blob_path(name)):
+        return None
+    return name
+
+
+def save_blob(data: bytes) -> str:
+    """Store image bytes and return the blob name. Duplicates are stored once.
+
+    Blocking; call from a worker thread inside async code.
+    """
+    if len(data) > MAX_IMAGE_BYTES:
+        raise ValueError("Rasm hajmi juda katta")
+    ext = sniff_image_type(data)
+    if ext is None:
+        raise ValueError("Faqat rasm fayllari qabul qilinadi")
+
+    name = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+    write_blob(name, data)
+    return name
+
+
+def write_blob(name: str, data: bytes):
+    """Write a blob under its name unless it already exists. Blocking."""
+    path = blob_path(name)
+    if os.path.exists(path):
+        return
+
+    # Write to a temp file and rename so readers never see a partial blob
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def decode_data_url(data_url: str) -> bytes:
+    """Decode a `data:image/...;base64,` URL as sent by older clients."""
+    header, _, payload = data_url.partition(",")
+    if not header.startswith("data:") or not header.endswith(";base64"):
+        raise ValueError("Rasm formati noto'g'ri")
+    # base64 inflates by 4/3, reject oversized payloads before decoding
+    if len(payload) > MAX_IMAGE_BYTES * 4 // 3 + 4:
+        raise ValueError("Rasm hajmi juda katta")
+    try:
+        return base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        raise ValueError("Rasm formati noto'g'ri")
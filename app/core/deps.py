@@ -0,0 +1,35 @@
+"""Shared FastAPI dependencies."""
+from fastapi import Depends, HTTPException, status
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+import hmac
+from app.core.security import ADMIN_TOKEN, get_username_from_token
+
+bearer_scheme = HTTPBearer(auto_error=False)
+
+
+async def get_current_username(
+    credentials: HTTPAuthorizationCredentials | None = Depends(bearer_scheme),
+) -> str:
+    """Resolve the username from an `Authorization: Bearer <token>` header."""
+    username = get_username_from_token(credentials.credentials) if credentials else None
+    if not username:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return username
+
+
+async def require_admin(
+    credentials: HTTPAuthorizationCredentials | None = Depends(bearer_scheme),
+):
+    """Allow the request only with `Authorization: Bearer <ADMIN_TOKEN>`."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin endpoints are disabled")
+    if credentials is None or not hmac.compare_digest(credentials.credentials, ADMIN_TOKEN):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid admin token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
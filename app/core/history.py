@@ -0,0 +1,211 @@
+"""Recent message history kept in memory in front of the messages table.
+
+Each room has a bounded ring buffer of already-serialized message frames. It is
+warmed from the database at startup, appended whenever a message is delivered
+through the backplane, and served to new connections without a query. Rooms
+that are not cached fall back to the database and are cached from then on; the
+least recently used rooms are evicted beyond HISTORY_CACHE_ROOMS. Messages
+delivered to an uncached room are kept aside and merged into its first load,
+so neither a load in progress nor the write-behind queue can hide them, and
+concurrent misses for one room share a single query.
+
+Reconnecting clients pass the id of the last message they saw and receive
+only what they missed (`resume`), from the cache when possible, otherwise from
+the database. Clients too far behind get a `resync` and the normal history.
+"""
+
+import asyncio
+from collections import OrderedDict, deque
+import os
+import time
+import zlib
+from dotenv import load_dotenv
+from sqlalchemy import and_, or_, select
+
+from app.core.database import ReadSessionLocal
+from app.core.images import image_fields
+from app.core.metrics import Counter, Histogram, since
+from app.core.serializer import encode
+from app.models.message import DEFAULT_ROOM, Message
+
+# Load environment variables from .env file
+load_dotenv()
+
+HISTORY_CACHE_DEPTH = int(os.getenv("HISTORY_CACHE_DEPTH", "50"))  # Messages kept per room
+HISTORY_CACHE_ROOMS = int(os.getenv("HISTORY_CACHE_ROOMS", "1000"))  # Rooms kept in memory
+# Compressed history batches are only worth it above this size
+HISTORY_COMPRESS_MIN_BYTES = int(os.getenv("HISTORY_COMPRESS_MIN_BYTES", "1024"))
+# Most missed messages replayed on resume before the client is told to resync
+RESUME_MAX_MESSAGES = int(os.getenv("RESUME_MAX_MESSAGES", "500"))
+RESYNC_FRAME = encode({"type": "resync"})
+
+QUERY_SECONDS = Histogram("chat_history_query_seconds", "History reads that missed the cache", ("kind",))
+CACHE_LOOKUPS = Counter("chat_history_cache_total", "History cache lookups", ("result",))
+
+
+def message_payload(msg: Message, is_sticker: bool | None = None) -> dict:
+    """Build the outbound `message` event for a stored message."""
+    data = {
+        "type": "message",
+        "id": msg.id,
+        "room": msg.room_id,
+        "username": msg.username,
+        "timestamp": msg.created_at.isoformat()
+    }
+    if msg.content:
+        data["message"] = msg.content
+        if is_sticker is None:
+            # Check if it's a sticker (single emoji character)
+            is_sticker = len(msg.content) == 1 and ord(msg.content) > 0x1F000
+    if msg.image:
+        data.update(image_fields(msg.image))
+    if is_sticker:
+        data["isSticker"] = True
+    return data
+
+
+def _batch_frame(kind: str, frames: list[str], compress: bool) -> str | bytes:
+    """Splice message frames into one batch frame without serializing them again.
+
+    With `compress=True` large batches are deflated into a binary frame.
+    """
+    frame = '{"type":"' + kind + '","messages":[' + ",".join(frames) + "]}"
+    if compress and len(frame) >= HISTORY_COMPRESS_MIN_BYTES:
+        return zlib.compress(frame.encode(), 6)
+    return frame
+
+
+class HistoryCache:
+    """Per-room ring buffers of recent, already-serialized message frames.
+
+    Entries are (message id, frame) pairs in delivery order.
+    """
+
+    def __init__(self, depth: int = HISTORY_CACHE_DEPTH, max_rooms: int = HISTORY_CACHE_ROOMS):
+        self.depth = depth
+        self.max_rooms = max_rooms
+        self._rooms: OrderedDict[str, deque] = OrderedDict()
+        # (room, compressed) -> batched history frame, rebuilt after each append
+        self._batches: dict[tuple[str, bool], str | bytes] = {}
+        # Uncached room -> newest messages delivered to it, merged in by the next load
+        self._partial: OrderedDict[str, deque] = OrderedDict()
+        self._loads: dict[str, asyncio.Task] = {}  # Database loads in flight, one per room
+
+    def append(self, room: str, message_id: int, frame: str):
+        """Record a delivered message."""
+        buffer = self._rooms.get(room)
+        if buffer is None:
+            buffer = self._partial.get(room)
+            if buffer is None:
+                buffer = self._partial[room] = deque(maxlen=self.depth)
+                while len(self._partial) > self.max_rooms:
+                    self._partial.popitem(last=False)
+            buffer.append((message_id, frame))
+            return
+        buffer.append((message_id, frame))
+        self._batches.pop((room, False), None)
+        self._batches.pop((room, True), None)
+
+    def get(self, room: str) -> list[str] | None:
+        """Cached frames, oldest first, or None on a cache miss."""
+        buffer = self._rooms.get(room)
+        if buffer is None:
+            return None
+        self._rooms.move_to_end(room)
+        return [frame for _, frame in buffer]
+
+    async def load(self, room: str) -> list[str]:
+        """Return the room's recent history, querying the database on a miss."""
+        frames = self.get(room)
+        if frames is not None:
+            CACHE_LOOKUPS.inc("hit")
+            return frames
+
+        CACHE_LOOKUPS.inc("miss")
+        task = self._loads.get(room)
+        if task is None:
+            task = self._loads[room] = asyncio.create_task(self._load(room))
+            task.add_done_callback(lambda _: self._loads.pop(room, None))
+        # Shielded so a client that disconnects does not cancel everyone's load
+        return await asyncio.shield(task)
+
+    async def _load(self, room: str) -> list[str]:
+        started = time.perf_counter()
+        async with ReadSessionLocal() as db:
+            result = await db.execute(
+                select(Message)
+                .where(Message.room_id == room)
+                .order_by(Message.created_at.desc(), Message.id.desc())
+                .limit(self.depth)
+            )
+            old_messages = result.scalars().all()
+        QUERY_SECONDS.observe(since(started), "load")
+        # Messages delivered while uncached are the newest; rows already in the
+        # database among them are taken from the delivered copy
+        delivered = self._partial.pop(room, ())
+        seen = {message_id for message_id, _ in delivered}
+        # Reverse to show oldest first
+        entries = [(msg.id, encode(message_payload(msg))) for msg in reversed(old_messages) if msg.id not in seen]
+        buffer = deque(entries, maxlen=self.depth)
+        buffer.extend(delivered)
+        self._rooms[room] = buffer
+        self._batches.pop((room, False), None)
+        self._batches.pop((room, True), None)
+        while len(self._rooms) > self.max_rooms:
+            evicted, _ = self._rooms.popitem(last=False)
+            self._batches.pop((evicted, False), None)
+            self._batches.pop((evicted, True), None)
+        return [frame for _, frame in buffer]
+
+    async def batch(self, room: str, compress: bool = False) -> str | bytes:
+        """The room's history as one `history` frame, memoized until the next append."""
+        cached = self._batches.get((room, compress))
+        if cached is not None:
+            return cached
+        frame = _batch_frame("history", await self.load(room), compress)
+        if room in self._rooms:
+            self._batches[(room, compress)] = frame
+        return frame
+
+    async def resume(self, room: str, after_id: int, compress: bool = False) -> str | bytes | None:
+        """A `resume` frame with the messages after `after_id`, or None if the client must resync."""
+        await self.load(room)
+        buffer = self._rooms.get(room)
+        if buffer is not None:
+            for index, (message_id, _) in enumerate(buffer):
+                if message_id == after_id:
+                    missed = [frame for _, frame in list(buffer)[index + 1:]]
+                    return _batch_frame("resume", missed, compress)
+
+        # Older than the cache: read the gap from the database, in stored order
+        started = time.perf_counter()
+        async with ReadSessionLocal() as db:
+            cursor = (await db.execute(
+                select(Message.created_at).where(Message.id == after_id, Message.room_id == room)
+            )).scalar()
+            if cursor is None:
+                return None  # Unknown cursor
+            result = await db.execute(
+                select(Message)
+                .where(Message.room_id == room, or_(
+                    Message.created_at > cursor,
+                    and_(Message.created_at == cursor, Message.id > after_id),
+                ))
+                .order_by(Message.created_at, Message.id)
+                .limit(RESUME_MAX_MESSAGES + 1)
+            )
+            missed = result.scalars().all()
+        QUERY_SECONDS.observe(since(started), "resume")
+        frames = [encode(message_payload(msg)) for msg in missed]
+        # The cursor is older than the whole cache, so every cached message is
+        # newer; those still in the write-behind queue are not in the database yet
+        stored = {msg.id for msg in missed}
+        frames.extend(frame for message_id, frame in self._rooms.get(room, ()) if message_id not in stored)
+        if len(frames) > RESUME_MAX_MESSAGES:
+            return None  # Too far behind
+        return _batch_frame("resume", frames, compress)
+
+    async def warm(self, room: str = DEFAULT_ROOM):
+        """Populate the cache at startup so the first connections skip the database."""
+        self._rooms.pop(room, None)
+        await self.load(room)
@@ -0,0 +1,111 @@
+"""Thumbnail and preview variants for uploaded chat images.
+
+Resizing runs in a process pool so it never blocks the event loop. Variants are
+stored in the blob store next to the original; message payloads reference the
+thumbnail and keep the original for the full-size view. Pillow is optional:
+without it only the original is served.
+"""
+
+import asyncio
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+
+from app.core.blobs import MEDIA_URL_PREFIX, blob_path, blob_url, variant_name, write_blob
+
+# Load environment variables from .env file
+load_dotenv()
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+VARIANT_FORMAT = "webp"
+VARIANT_QUALITY = int(os.getenv("VARIANT_QUALITY", "80"))
+# Variant name -> longest side in pixels
+VARIANTS = {
+    "thumb": int(os.getenv("THUMBNAIL_SIZE", "320")),
+    "preview": int(os.getenv("PREVIEW_SIZE", "1024")),
+}
+
+_executor: ProcessPoolExecutor | None = None
+
+
+def _render_variants(data: bytes) -> dict[str, bytes]:
+    """Downscale image bytes into every configured variant. Runs in a worker process."""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return {}
+
+    with Image.open(io.BytesIO(data)) as image:
+        if getattr(image, "is_animated", False):
+            return {}  # Keep animations as they are
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+        rendered = {}
+        for variant, size in VARIANTS.items():
+            if max(image.size) <= size and rendered:
+                break  # Larger variants would just repeat the original size
+            copy = image.copy()
+            copy.thumbnail((size, size))
+            buffer = io.BytesIO()
+            copy.save(buffer, format=VARIANT_FORMAT, quality=VARIANT_QUALITY)
+            rendered[variant] = buffer.getvalue()
+        return rendered
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn: forking a process that holds DB threads and sockets is unsafe
+        _executor = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+
+def shutdown():
+    """Stop the worker processes. Called on application shutdown."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _save_variants(name: str, rendered: dict[str, bytes]):
+    for variant, data in rendered.items():
+        write_blob(variant_name(name, variant, VARIANT_FORMAT), data)
+
+
+async def create_variants(name: str):
+    """Generate any missing variants for the blob `name` off the event loop."""
+    if os.path.exists(blob_path(variant_name(name, "thumb", VARIANT_FORMAT))):
+        return  # Already processed (duplicate upload)
+    data = await asyncio.to_thread(_read, blob_path(name))
+    loop = asyncio.get_running_loop()
+    rendered = await loop.run_in_executor(_get_executor(), _render_variants, data)
+    await asyncio.to_thread(_save_variants, name, rendered)
+
+
+def variant_url(name: str, variant: str) -> str | None:
+    """URL of a stored variant, or None if it was not generated."""
+    vname = variant_name(name, variant, VARIANT_FORMAT)
+    if os.path.exists(blob_path(vname)):
+        return blob_url(vname)
+    return None
+
+
+def image_fields(url: str) -> dict:
+    """Payload fields for a message image: thumbnail by default, original on demand."""
+    thumb = None
+    if url.startswith(MEDIA_URL_PREFIX):
+        thumb = variant_url(url[len(MEDIA_URL_PREFIX):], "thumb")
+    return {"image": thumb or url, "imageFull": url}
@@ -3,23 +3,28 @@
 Run with:
     python -m app.core.init_db
 
-This creates SQLite tables using a synchronous engine derived from DATABASE_URL in database.py.
+This creates the tables through the async engine from database.py, so it works
+for both SQLite (aiosqlite) and Postgres (asyncpg) DATABASE_URLs. On SQLite the
+connection pragmas (WAL journal mode etc.) are applied as well, and the
+full-text search index from search.py is created with the messages table.
 """
 
-from sqlalchemy import create_engine
-from app.core.database import Base, DATABASE_URL
-
-# DATABASE_URL is async (sqlite+aiosqlite:///...), create a sync URL for table creation
-sync_url = DATABASE_URL.replace("+aiosqlite", "")
-
-engine = create_engine(sync_url, echo=False, future=True)
+import asyncio
+from app.core.database import Base, engine
 
 # Import models so they are registered on Base.metadata
 import app.models  # noqa: F401
+# Registers the full-text search DDL that runs after the messages table is created
+import app.core.search  # noqa: F401
+
+async def _create_all():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    await engine.dispose()
 
 def init_db():
-    Base.metadata.create_all(bind=engine)
-    print("Database initialized (chat.db)")
+    asyncio.run(_create_all())
+    print("Database initialized")
 
 if __name__ == "__main__":
     init_db()
@@ -1,105 +1,583 @@
-from fastapi import WebSocket
+from fastapi import WebSocket, WebSocketDisconnect
 from typing import List, Dict
-import json
+from collections import deque
+import asyncio
+import itertools
+import os
+import random
+import time
+from dotenv import load_dotenv
 
 from contextlib import asynccontextmanager
+from app.core.serializer import encode, to_msgpack
+from app.core.protocol import SUBPROTOCOL_MSGPACK
+from app.core.backplane import Backplane, MemoryBackplane, pack, unpack
+from app.core.history import DEFAULT_ROOM, HistoryCache
+from app.core.persistence import MessageWriter
+from app.core.presence import PRESENCE_HEARTBEAT, PRESENCE_TICK, Presence
+from app.core.metrics import ERRORS, Counter, Gauge, Histogram, since
+
+# Load environment variables from .env file
+load_dotenv()
+
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "256"))  # Max queued frames per connection
+# What to do when a connection's outbound queue is full:
+#   drop_oldest - discard the oldest queued frame
+#   coalesce    - replace a queued frame with the same key (e.g. typing), else drop the oldest
+#   disconnect  - close the slow consumer
+SEND_QUEUE_OVERFLOW = os.getenv("SEND_QUEUE_OVERFLOW", "drop_oldest")
+OVERFLOW_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+if SEND_QUEUE_OVERFLOW not in OVERFLOW_POLICIES:
+    raise ValueError(f"SEND_QUEUE_OVERFLOW must be one of {', '.join(OVERFLOW_POLICIES)}")
+TYPING_TICK = float(os.getenv("TYPING_TICK", "0.3"))  # Seconds between "who is typing" snapshots
+TYPING_TTL = float(os.getenv("TYPING_TTL", "5"))  # Seconds until an unrefreshed typer expires
+METRICS_MAX_ROOMS = int(os.getenv("METRICS_MAX_ROOMS", "50"))  # Largest rooms reported by name
+# The server pings connections that have been silent for HEARTBEAT_INTERVAL and
+# closes those silent for HEARTBEAT_TIMEOUT; 0 disables the heartbeat
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "25"))
+HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", "60"))
+HEARTBEAT_SLOTS = 10  # Wheel slots: each tick checks one, so the work is spread over the interval
+
+# Draining closes connections in batches of DRAIN_BATCH_SIZE, DRAIN_BATCH_INTERVAL
+# seconds apart, and tells each client to wait a random 0..DRAIN_RECONNECT_WINDOW
+# milliseconds before reconnecting, so they do not all land on the next instance at once
+DRAIN_BATCH_SIZE = int(os.getenv("DRAIN_BATCH_SIZE", "200"))
+DRAIN_BATCH_INTERVAL = float(os.getenv("DRAIN_BATCH_INTERVAL", "0.1"))
+DRAIN_RECONNECT_WINDOW = int(os.getenv("DRAIN_RECONNECT_WINDOW", "10000"))
+DRAIN_FLUSH_TIMEOUT = float(os.getenv("DRAIN_FLUSH_TIMEOUT", "2"))  # Max seconds to flush one outbox
+
+# Answered by clients with {"type": "pong"}; encoded once
+PING_FRAME = encode({"type": "ping"})
+
+CONNECTIONS = Gauge("chat_connections", "Open WebSocket connections on this worker, by room", ("room",))
+OUTBOX_PENDING = Gauge("chat_outbox_pending_frames", "Frames waiting in outbound queues", ("stat",))
+FANOUT_SECONDS = Histogram("chat_broadcast_fanout_seconds", "Time to queue one event for every local recipient")
+SEND_SECONDS = Histogram("chat_send_latency_seconds", "Time from queueing a frame until it is written to the socket")
+DROPPED_FRAMES = Counter("chat_outbox_dropped_frames_total", "Frames discarded by the overflow policy")
+EVICTED = Counter("chat_evicted_connections_total", "Slow consumers disconnected by the overflow policy")
+HEARTBEAT_PINGS = Counter("chat_heartbeat_pings_total", "Pings sent to silent connections")
+REAPED = Counter("chat_reaped_connections_total", "Connections closed for missing the heartbeat")
+
+
+class Outbox:
+    """Bounded outbound queue with its own writer task for a single WebSocket."""
+
+    __slots__ = ("websocket", "maxsize", "overflow", "dropped", "closed", "_queue", "_wakeup",
+                 "_on_error", "_task", "_flushed")
+
+    def __init__(self, websocket: WebSocket, on_error, maxsize: int = SEND_QUEUE_SIZE,
+                 overflow: str = SEND_QUEUE_OVERFLOW):
+        self.websocket = websocket
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.dropped = 0
+        self.closed = False
+        self._queue: deque = deque()
+        self._wakeup = asyncio.Event()
+        self._on_error = on_error
+        self._flushed: asyncio.Event | None = None  # Set once the queue is empty, see flush()
+        self._task = asyncio.create_task(self._writer())
+
+    @property
+    def pending(self) -> int:
+        return len(self._queue)
+
+    def put(self, message: str | bytes, key: str | None = None, queued_at: float | None = None) -> bool:
+        """Queue a frame without blocking. Returns False if the consumer should be dropped."""
+        if self.closed:
+            return False
+        if len(self._queue) >= self.maxsize:
+            if self.overflow == "disconnect":
+                return False
+            if self.overflow == "coalesce" and key is not None and self._discard_key(key):
+                pass
+            else:
+                self._queue.popleft()
+            self.dropped += 1
+            DROPPED_FRAMES.inc()
+        self._queue.append((key, message, queued_at or time.perf_counter()))
+        self._wakeup.set()
+        return True
+
+    def _discard_key(self, key: str) -> bool:
+        """Remove the oldest queued frame carrying the given coalesce key."""
+        for index, (queued_key, _, _) in enumerate(self._queue):
+            if queued_key == key:
+                del self._queue[index]
+                return True
+        return False
+
+    async def _writer(self):
+        websocket = self.websocket
+        try:
+            while not self.closed:
+                while self._queue:
+                    _, message, queued_at = self._queue.popleft()
+                    if isinstance(message, bytes):
+                        await websocket.send_bytes(message)
+                    else:
+                        await websocket.send_text(message)
+                    SEND_SECONDS.observe(since(queued_at))
+                if self._flushed is not None:
+                    self._flushed.set()
+                    self._flushed = None
+                self._wakeup.clear()
+                await self._wakeup.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Socket is gone; let the manager forget about it
+            ERRORS.inc("outbox_send")
+            self.closed = True
+            self._queue.clear()
+            self._on_error()
+
+    async def flush(self):
+        """Wait until every queued frame has been written to the socket."""
+        if self.closed:
+            return
+        if self._flushed is None:
+            self._flushed = asyncio.Event()
+        flushed = self._flushed
+        self._wakeup.set()  # Idle writer passes its loop once and reports
+        await flushed.wait()
+
+    def close(self):
+        """Stop the writer task and discard anything still queued."""
+        self.closed = True
+        self._queue.clear()
+        self._task.cancel()
+        if self._flushed is not None:
+            self._flushed.set()
+
+
+class Connection:
+    """Registry record for one accepted WebSocket."""
+
+    __slots__ = ("id", "websocket", "username", "room", "outbox", "binary", "buckets", "last_seen")
+
+    def __init__(self, id: int, websocket: WebSocket, username: str, room: str, binary: bool = False):
+        self.id = id
+        self.websocket = websocket
+        self.username = username
+        self.room = room
+        self.outbox: Outbox | None = None
+        self.binary = binary  # Frames go out as MessagePack instead of JSON text
+        self.buckets: dict[str, list[float]] = {}  # Per-connection rate limit buckets
+        self.last_seen = time.monotonic()  # Updated on every received frame
+
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-        self.usernames: dict[WebSocket, str] = {}
-        self.typing_users: Dict[str, bool] = {}  # Track typing status
+    def __init__(self, backplane: Backplane | None = None, history: HistoryCache | None = None,
+                 writer: MessageWriter | None = None, presence: Presence | None = None):
+        # Broadcasts are published here and fanned out locally when they come back
+        self.backplane = backplane or MemoryBackplane()
+        # Recent messages, appended as they are delivered so every worker stays in sync
+        self.history = history or HistoryCache()
+        # Write-behind message persistence, flushed on shutdown
+        self.writer = writer or MessageWriter()
+        # Online users per room across all workers, sent as snapshot + deltas
+        self.presence = presence or Presence()
+        # Every index is a dict keyed by connection id, so registering and
+        # removing a connection is O(1) no matter how many are open
+        self.connections: dict[int, Connection] = {}
+        self.rooms: Dict[str, dict[int, Connection]] = {}  # room -> its local connections
+        self.users: Dict[str, dict[int, Connection]] = {}  # username -> connections (one per tab)
+        self.room_users: Dict[str, dict[str, int]] = {}  # room -> username -> connection count
+        self.typing_users: Dict[str, dict[str, float]] = {}  # room -> username -> expiry
+        self._typing_dirty: set[str] = set()  # Rooms whose snapshot changed since the last tick
+        self._typing_task: asyncio.Task | None = None
+        self._presence_task: asyncio.Task | None = None
+        # Timer wheel: connections spread over slots by id, one slot checked per tick
+        self._wheel: list[dict[int, Connection]] = [{} for _ in range(HEARTBEAT_SLOTS)]
+        self._heartbeat_task: asyncio.Task | None = None
+        # Drain mode: new sockets are refused while existing ones are handed off
+        self.draining = False
+        self._drain_task: asyncio.Task | None = None
+        self._drain_total = 0
+        self._drain_started: float | None = None
+        self._drain_finished: float | None = None
+        self._ids = itertools.count(1)
         self._shutdown = False
-    
+        CONNECTIONS.set_function(self._connection_counts)
+        OUTBOX_PENDING.set_function(self._outbox_pending)
+
     @asynccontextmanager
     async def lifespan(self):
+        try:
+            await self.history.warm()
+        except Exception:
+            ERRORS.inc("history_warm")  # Cache stays cold; history falls back to the database
+        await self.writer.start()
+        await self.backplane.start(self._on_event)
+        # Ask workers that are already running for their users
+        await self.backplane.publish(pack("", control="presence_sync", instance=self.presence.instance_id))
+        self._typing_task = asyncio.create_task(self._typing_ticker())
+        self._presence_task = asyncio.create_task(self._presence_ticker())
+        if HEARTBEAT_INTERVAL > 0:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_ticker())
         try:
             yield
         finally:
+            # Hand off whatever is still connected before tearing anything down
+            try:
+                await self.start_drain()
+            except Exception:
+                ERRORS.inc("drain")
             self._shutdown = True
+            self._typing_task.cancel()
+            self._presence_task.cancel()
+            if self._heartbeat_task is not None:
+                self._heartbeat_task.cancel()
             # Close all active connections during shutdown
-            for connection in self.active_connections.copy():
+            for conn in list(self.connections.values()):
+                self.disconnect(conn)
                 try:
-                    await connection.close(code=1000)  # Normal closure
+                    await conn.websocket.close(code=1000)  # Normal closure
                 except Exception:
                     pass
-            self.active_connections.clear()
-            self.usernames.clear()
+            # Tell the other workers these users are gone
+            try:
+                await self._publish_presence()
+            except Exception:
+                ERRORS.inc("presence_publish")
+            await self.backplane.stop()
+            # Make sure every accepted message reaches the database
+            await self.writer.stop()
 
-    async def connect(self, websocket: WebSocket, username: str):
+    async def connect(self, websocket: WebSocket, username: str, room: str = DEFAULT_ROOM,
+                      subprotocol: str | None = None) -> Connection:
+        """Accept a socket and register it. Returns its registry record.
+
+        The connection gets no room traffic until `join()`, so its history can
+        be loaded first without the messages delivered meanwhile arriving twice.
+        """
+        conn = Connection(next(self._ids), websocket, username, room, subprotocol == SUBPROTOCOL_MSGPACK)
         try:
-            await websocket.accept()
-            self.active_connections.append(websocket)
-            self.usernames[websocket] = username
-            # Send welcome message only to already connected clients
-            existing_connections = self.active_connections[:-1]  # All except the new connection
-            for conn in existing_connections:
-                await conn.send_text(f"🔵 {username} chatga qo'shildi")
+            await websocket.accept(subprotocol=subprotocol)
+            if self.draining:
+                # The drain started during the accept and has already taken its snapshot
+                await self._close_quietly(websocket, 1012)  # Service restart
+                raise WebSocketDisconnect(1012)
+            conn.outbox = Outbox(websocket, lambda: self.disconnect(conn))
+            self.connections[conn.id] = conn
+            self.users.setdefault(username, {})[conn.id] = conn
+            self._wheel[conn.id % HEARTBEAT_SLOTS][conn.id] = conn
         except Exception:
             # If anything goes wrong, make sure to clean up
-            if websocket in self.active_connections:
-                self.active_connections.remove(websocket)
-            if websocket in self.usernames:
-                del self.usernames[websocket]
+            self.disconnect(conn)
             raise
+        return conn
+
+    def join(self, conn: Connection):
+        """Add a connection to its room: live messages and presence from here on."""
+        if conn.id not in self.connections:
+            return  # Closed while its history was loading
+        self.rooms.setdefault(conn.room, {})[conn.id] = conn
+        counts = self.room_users.setdefault(conn.room, {})
+        counts[conn.username] = counts.get(conn.username, 0) + 1
+        if counts[conn.username] == 1:
+            self.presence.local_join(conn.room, conn.username)
+
+    def disconnect(self, conn: Connection) -> bool:
+        """Forget a connection. Returns False if it was already removed."""
+        if self.connections.pop(conn.id, None) is None:
+            if conn.outbox is not None:
+                conn.outbox.close()
+            return False
+        conn.outbox.close()
+        self._discard(self.users, conn.username, conn.id)
+        self._wheel[conn.id % HEARTBEAT_SLOTS].pop(conn.id, None)
+        if conn.id not in self.rooms.get(conn.room, ()):
+            return True  # Never joined its room
+        self._discard(self.rooms, conn.room, conn.id)
+        counts = self.room_users[conn.room]
+        counts[conn.username] -= 1
+        if not counts[conn.username]:
+            del counts[conn.username]
+            if not counts:
+                del self.room_users[conn.room]
+            self.presence.local_leave(conn.room, conn.username)
+        return True
+
+    @staticmethod
+    def _discard(index: dict, key: str, conn_id: int):
+        members = index.get(key)
+        if members is not None:
+            members.pop(conn_id, None)
+            if not members:
+                del index[key]
+
+    def _evict(self, conn: Connection):
+        """Drop a consumer that cannot keep up and close its socket in the background."""
+        EVICTED.inc()
+        self.disconnect(conn)
+        asyncio.create_task(self._close_quietly(conn.websocket, 1013))  # Try again later
+
+    def start_drain(self) -> asyncio.Task:
+        """Start draining (once) and return the task that finishes when it is done."""
+        if self._drain_task is None:
+            self.draining = True
+            self._drain_started = time.monotonic()
+            connections = list(self.connections.values())
+            self._drain_total = len(connections)
+            self._drain_task = asyncio.create_task(self._drain(connections))
+        return self._drain_task
+
+    async def _drain(self, connections: list[Connection]):
+        """Flush and close connections in paced batches, then flush persistence."""
+        for start in range(0, len(connections), DRAIN_BATCH_SIZE):
+            if start:
+                await asyncio.sleep(DRAIN_BATCH_INTERVAL)
+            batch = connections[start:start + DRAIN_BATCH_SIZE]
+            await asyncio.gather(*(self._hand_off(conn) for conn in batch))
+        try:
+            while self.writer.pending:
+                await self.writer.flush()
+        except Exception:
+            ERRORS.inc("persist_flush")  # Retried by writer.stop() on shutdown
+        self._drain_finished = time.monotonic()
 
-    def disconnect(self, websocket: WebSocket):
-        username = self.usernames.get(websocket, "Noma'lum")
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        if websocket in self.usernames:
-            del self.usernames[websocket]
-        return username
-
-    async def broadcast(self, message: str):
-        # Make a copy of connections to avoid modification during iteration
-        connections = self.active_connections.copy()
-        disconnected = []
-        
-        for connection in connections:
+    async def _hand_off(self, conn: Connection):
+        """Deliver a connection's queued frames plus a reconnect hint, then close it."""
+        if conn.id not in self.connections:
+            return  # Closed on its own meanwhile
+        self.send(conn, encode({"type": "reconnect", "after_ms": random.randint(0, DRAIN_RECONNECT_WINDOW)}))
+        try:
+            await asyncio.wait_for(conn.outbox.flush(), DRAIN_FLUSH_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass  # Slow consumer; it resumes from its last message id anyway
+        self.disconnect(conn)
+        await self._close_quietly(conn.websocket, 1012)  # Service restart
+
+    def drain_progress(self) -> dict:
+        """Drain state for the admin endpoint."""
+        if not self.draining:
+            state = "serving"
+        elif self._drain_finished is None:
+            state = "draining"
+        else:
+            state = "drained"
+        end = self._drain_finished or time.monotonic()
+        return {
+            "state": state,
+            "total": self._drain_total,
+            "remaining": len(self.connections),
+            "persist_pending": self.writer.pending,
+            "elapsed_seconds": round(end - self._drain_started, 3) if self._drain_started else 0.0,
+        }
+
+    @staticmethod
+    async def _close_quietly(websocket: WebSocket, code: int):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    def send(self, conn: Connection, message: str | bytes, key: str | None = None):
+        """Queue a frame for one connection."""
+        if conn.binary and isinstance(message, str):
+            message = to_msgpack(message)
+        if conn.outbox is not None and not conn.outbox.put(message, key):
+            self._evict(conn)
+
+    async def send_json(self, conn: Connection, data: dict):
+        """Queue JSON data for one connection."""
+        self.send(conn, encode(data))
+
+    async def broadcast(self, message: str, key: str | None = None, exclude: str | None = None,
+                        history_id: int | None = None, room: str = DEFAULT_ROOM):
+        """Publish an already encoded frame to a room's connections on every worker.
+
+        With `history_id` (a message id) the frame is also recorded in the history cache.
+        """
+        await self.backplane.publish(pack(message, key=key, exclude=exclude, history=history_id, room=room))
+
+    async def _on_event(self, raw: str | bytes):
+        """Fan out an event received from the backplane to local connections."""
+        meta, message = unpack(raw)
+        room = meta.get("room", DEFAULT_ROOM)
+        control = meta.get("control")
+        if control == "typing":
+            self._apply_typing(room, meta["username"], meta["typing"])
+            return
+        if control in ("presence", "presence_alive"):
+            if self.presence.heard(meta["instance"], time.monotonic()):
+                # Its users were expired while it was unreachable: ask it for them again
+                await self.backplane.publish(pack("", control="presence_sync", instance=self.presence.instance_id,
+                                                  target=meta["instance"]))
+            if control == "presence":
+                self.presence.apply(meta["instance"], meta["changes"])
+            return
+        if control == "presence_sync":
+            # Without a target it comes from a worker that just started and wants everyone's users
+            target = meta.get("target", self.presence.instance_id)
+            if meta["instance"] != self.presence.instance_id and target == self.presence.instance_id:
+                await self.backplane.publish(pack("", control="presence", instance=self.presence.instance_id,
+                                                  changes=self.presence.local_state()))
+            return
+        if meta.get("history") is not None:
+            self.history.append(room, meta["history"], message)
+        self._fanout(message, meta.get("key"), meta.get("exclude"), room)
+
+    def _fanout(self, message: str, key: str | None = None, exclude: str | None = None,
+                room: str = DEFAULT_ROOM):
+        """Queue a frame on every local connection in the room without waiting for delivery."""
+        members = self.rooms.get(room)
+        if not members:
+            return
+        started = time.perf_counter()
+        slow = []
+        binary = None  # MessagePack copy, encoded once on first use
+        for conn in members.values():
+            if exclude is not None and conn.username == exclude:
+                continue
+            frame = message
+            if conn.binary:
+                if binary is None:
+                    binary = to_msgpack(message)
+                frame = binary
+            if not conn.outbox.put(frame, key, started):
+                slow.append(conn)
+
+        # Disconnect consumers rejected by the overflow policy
+        for conn in slow:
+            self._evict(conn)
+        FANOUT_SECONDS.observe(since(started))
+
+    async def broadcast_json(self, data: dict, history: bool = False, room: str = DEFAULT_ROOM):
+        """Broadcast JSON data to all clients in a room."""
+        await self.broadcast(encode(data), history_id=data["id"] if history else None, room=room)
+
+    async def user_typing(self, username: str, is_typing: bool, room: str = DEFAULT_ROOM):
+        """Record a user's typing state; rooms get a combined snapshot on the next tick.
+
+        Only state changes (and refreshes of entries about to expire) go over
+        the backplane, so repeated keystroke events cost nothing.
+        """
+        expires = self.typing_users.get(room, {}).get(username)
+        if is_typing:
+            if expires is not None and expires - time.monotonic() > TYPING_TTL / 2:
+                return
+        elif expires is None:
+            return
+        await self.backplane.publish(pack("", control="typing", room=room, username=username,
+                                          typing=is_typing))
+
+    def _apply_typing(self, room: str, username: str, is_typing: bool):
+        users = self.typing_users.setdefault(room, {})
+        if is_typing:
+            if username not in users:
+                self._typing_dirty.add(room)
+            users[username] = time.monotonic() + TYPING_TTL
+        elif users.pop(username, None) is not None:
+            self._typing_dirty.add(room)
+        if not users:
+            del self.typing_users[room]
+
+    async def _typing_ticker(self):
+        """Expire stale typers and send one snapshot per changed room every TYPING_TICK."""
+        while True:
+            await asyncio.sleep(TYPING_TICK)
+            now = time.monotonic()
+            for room, users in list(self.typing_users.items()):
+                stale = [username for username, expires in users.items() if expires <= now]
+                for username in stale:
+                    del users[username]
+                if stale:
+                    self._typing_dirty.add(room)
+                    if not users:
+                        del self.typing_users[room]
+
+            dirty, self._typing_dirty = self._typing_dirty, set()
+            for room in dirty:
+                if room in self.rooms:
+                    frame = encode({"type": "typing", "users": sorted(self.typing_users.get(room, ()))})
+                    self._fanout(frame, key="typing", room=room)
+
+    async def _publish_presence(self):
+        changes = self.presence.take_outgoing()
+        if changes:
             try:
-                await connection.send_text(message)
+                await self.backplane.publish(pack("", control="presence", instance=self.presence.instance_id,
+                                                  changes=changes))
             except Exception:
-                # Mark for removal if sending fails
-                disconnected.append(connection)
-                
-        # Clean up any disconnected clients
-        for conn in disconnected:
-            if conn in self.active_connections:
-                self.active_connections.remove(conn)
-            if conn in self.usernames:
-                del self.usernames[conn]
-
-    async def broadcast_json(self, data: dict):
-        """Broadcast JSON data to all connected clients."""
-        message = json.dumps(data, ensure_ascii=False)
-        await self.broadcast(message)
-
-    async def user_typing(self, username: str, is_typing: bool):
-        """Update and broadcast typing status for a user."""
-        if is_typing:
-            self.typing_users[username] = True
-        else:
-            self.typing_users.pop(username, None)
-        
-        # Broadcast typing status to all clients except the user who is typing
-        typing_list = list(self.typing_users.keys())
-        for connection in self.active_connections.copy():
+                self.presence.restore_outgoing(changes)
+                raise
+
+    async def _presence_ticker(self):
+        """Every PRESENCE_TICK, publish local joins/leaves and send each changed room one delta.
+
+        Also sends this worker's heartbeat and expires the users of workers that stopped sending theirs.
+        """
+        beat = 0.0
+        while True:
+            await asyncio.sleep(PRESENCE_TICK)
             try:
-                # Don't send typing status to the user who is typing
-                if self.usernames.get(connection) != username:
-                    await connection.send_json({
-                        "type": "typing",
-                        "username": username,
-                        "is_typing": is_typing
-                    })
+                await self._publish_presence()
             except Exception:
-                # Mark for removal if sending fails
-                if connection in self.active_connections:
-                    self.active_connections.remove(connection)
-                if connection in self.usernames:
-                    del self.usernames[connection]
-
-    def get_online_users(self) -> List[str]:
-        """Get list of currently online usernames."""
-        return list(self.usernames.values())
+                ERRORS.inc("presence_publish")  # Retried on the next tick
+            now = time.monotonic()
+            if now - beat >= PRESENCE_HEARTBEAT:
+                try:
+                    await self.backplane.publish(pack("", control="presence_alive", instance=self.presence.instance_id))
+                    beat = now
+                except Exception:
+                    ERRORS.inc("presence_publish")
+            self.presence.expire(now)
+            for room, frame in self.presence.deltas():
+                self._fanout(frame, room=room)
+
+    async def _heartbeat_ticker(self):
+        """Check one wheel slot per tick, so each connection is visited once per HEARTBEAT_INTERVAL.
+
+        A single task serves every connection; nothing is scheduled per socket.
+        """
+        tick = HEARTBEAT_INTERVAL / HEARTBEAT_SLOTS
+        slot = 0
+        while True:
+            await asyncio.sleep(tick)
+            try:
+                self._heartbeat(self._wheel[slot], time.monotonic())
+            except Exception:
+                ERRORS.inc("heartbeat")
+            slot = (slot + 1) % HEARTBEAT_SLOTS
+
+    def _heartbeat(self, connections: dict[int, Connection], now: float):
+        """Ping silent connections and reap the ones that stopped answering."""
+        for conn in list(connections.values()):
+            silent = now - conn.last_seen
+            if silent >= HEARTBEAT_TIMEOUT:
+                # Half-open or hung: stop broadcasting to it right away
+                REAPED.inc()
+                self.disconnect(conn)
+                asyncio.create_task(self._close_quietly(conn.websocket, 1011))
+            elif silent >= HEARTBEAT_INTERVAL:
+                HEARTBEAT_PINGS.inc()
+                self.send(conn, PING_FRAME, key="ping")
+
+    def presence_snapshot(self, room: str) -> str:
+        """Full online list for a room, sent on connect and on resync requests."""
+        return self.presence.snapshot(room)
+
+    def _connection_counts(self) -> dict[tuple, int]:
+        """Connections per room for /metrics; small rooms are summed under "_other"."""
+        sizes = sorted(((len(members), room) for room, members in self.rooms.items()), reverse=True)
+        counts = {(room,): size for size, room in sizes[:METRICS_MAX_ROOMS]}
+        if len(sizes) > METRICS_MAX_ROOMS:
+            counts[("_other",)] = sum(size for size, _ in sizes[METRICS_MAX_ROOMS:])
+        return counts
+
+    def _outbox_pending(self) -> dict[tuple, int]:
+        pending = [conn.outbox.pending for conn in self.connections.values()]
+        return {("total",): sum(pending), ("max",): max(pending, default=0)}
+
+    def get_online_users(self, room: str | None = None) -> List[str]:
+        """Get list of currently online usernames on all workers, optionally for one room."""
+        if room is None:
+            return list(self.presence.all_users())
+        return self.presence.users(room)
+
+    def is_online(self, username: str) -> bool:
+        """True if the user has a connection on this worker."""
+        return username in self.users
@@ -0,0 +1,153 @@
+"""Prometheus metrics without extra dependencies.
+
+Modules define their metrics at import time and update them on the hot path;
+`render()` produces the text exposition format served at /metrics. Updates
+are a dict lookup and an add (histograms add a bisect), so instrumentation can
+stay on under load. Gauges that mirror existing state use a callback that is
+only evaluated when metrics are scraped.
+"""
+
+import asyncio
+from bisect import bisect_left
+import os
+import time
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # Bearer token required for /metrics when set
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))  # Seconds between lag probes
+
+# Seconds, from sub-millisecond queue hops to multi-second stalls
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry: dict[str, "Metric"] = {}
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        _registry[name] = self  # Re-creating a metric replaces it
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_labels(self.labelnames, labels)} {value}"
+                for labels, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """A value that is set directly, or read from a callback at scrape time.
+
+    The callback returns a number, or a dict of label tuple -> number.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), function=None):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple, float] = {}
+        self._function = function
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def samples(self) -> list[str]:
+        values = self._values
+        if self._function is not None:
+            result = self._function()
+            values = result if isinstance(result, dict) else {(): result}
+        return [f"{self.name}{_labels(self.labelnames, labels)} {value}"
+                for labels, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+        # labels -> [per-bucket counts (+Inf last), sum]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text format."""
+    return "\n".join(metric.render() for metric in _registry.values()) + "\n"
+
+
+# Shared by every module that used to swallow exceptions silently
+ERRORS = Counter("chat_errors_total", "Exceptions caught and handled, by location", ("where",))
+
+LOOP_LAG_SECONDS = Histogram("chat_event_loop_lag_seconds", "Delay of event loop wakeups past their deadline")
+
+
+async def monitor_event_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """Measure how late the event loop wakes up; anything blocking it shows up here."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - expected))
+
+
+def since(started: float) -> float:
+    """Seconds elapsed since a time.perf_counter() reading."""
+    return time.perf_counter() - started
@@ -0,0 +1,239 @@
+"""Write-behind persistence for chat messages.
+
+Message ids and timestamps are assigned in-process so a message can be
+broadcast before it reaches the database. Queued messages are then written in
+multi-row INSERTs whenever PERSIST_BATCH_SIZE messages are waiting or
+PERSIST_FLUSH_INTERVAL seconds have passed.
+
+Durability modes (PERSIST_MODE):
+    sync        - insert and commit each message before it is broadcast
+    batched     - broadcast first, flush in batches; failed batches are retried
+                  and a full queue makes senders wait for a flush
+    best_effort - like batched, but failed batches and queue overflow are dropped
+
+Ids come from blocks of PERSIST_ID_BLOCK reserved atomically in the
+`id_sequences` table, so any number of worker processes can share a database
+without colliding. A batch that fails is retried row by row; rows the database
+rejects outright (e.g. constraint violations) are dropped and counted instead
+of blocking every message behind them.
+"""
+
+import asyncio
+from collections import deque
+from datetime import datetime
+import os
+import time
+from dotenv import load_dotenv
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.core.database import SessionLocal
+from app.core.metrics import ERRORS, Counter, Gauge, Histogram, since
+from app.models.message import DEFAULT_ROOM, IdSequence, Message
+
+# Load environment variables from .env file
+load_dotenv()
+
+PERSIST_MODE = os.getenv("PERSIST_MODE", "batched")
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "200"))
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "0.05"))  # seconds
+PERSIST_QUEUE_SIZE = int(os.getenv("PERSIST_QUEUE_SIZE", "10000"))
+PERSIST_ID_BLOCK = int(os.getenv("PERSIST_ID_BLOCK", "1000"))  # Message ids reserved per database round trip
+
+COMMIT_SECONDS = Histogram("chat_db_commit_seconds", "Time to insert and commit one batch of messages")
+PERSISTED = Counter("chat_messages_persisted_total", "Messages written to the database")
+PERSIST_DROPPED = Counter("chat_messages_persist_dropped_total", "Messages dropped in best_effort mode")
+PERSIST_REJECTED = Counter("chat_messages_persist_rejected_total", "Messages the database refused to store")
+PERSIST_PENDING = Gauge("chat_persist_queue_pending", "Messages waiting for the batch flusher")
+
+PERSIST_MODES = ("sync", "batched", "best_effort")
+if PERSIST_MODE not in PERSIST_MODES:
+    raise ValueError(f"PERSIST_MODE must be one of {', '.join(PERSIST_MODES)}")
+
+
+class MessageWriter:
+    """Assigns message ids in-process and persists messages in batches."""
+
+    def __init__(self, session_factory=SessionLocal, mode: str = PERSIST_MODE,
+                 batch_size: int = PERSIST_BATCH_SIZE, flush_interval: float = PERSIST_FLUSH_INTERVAL,
+                 max_queue: int = PERSIST_QUEUE_SIZE, id_block: int = PERSIST_ID_BLOCK):
+        self.session_factory = session_factory
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.id_block = id_block
+        self.dropped = 0
+        self.rejected = 0
+        self._next_id: int | None = None
+        self._last_id = 0  # Last id of the reserved block
+        self._id_lock = asyncio.Lock()
+        self._queue: deque[dict] = deque()
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        PERSIST_PENDING.set_function(lambda: len(self._queue))
+
+    @property
+    def pending(self) -> int:
+        return len(self._queue)
+
+    async def start(self):
+        """Reserve the first block of ids and start the background flusher."""
+        async with self.session_factory() as db:
+            # Databases created before id blocks existed get the table here
+            conn = await db.connection()
+            await conn.run_sync(lambda sync_conn: IdSequence.__table__.create(sync_conn, checkfirst=True))
+            await db.commit()
+        await self._reserve_ids()
+        if self.mode != "sync":
+            self._task = asyncio.create_task(self._flusher())
+
+    async def stop(self):
+        """Stop the flusher and write out everything still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._queue:
+            try:
+                await self.flush()
+            except Exception:
+                ERRORS.inc("persist_shutdown")
+                break  # Database is gone; nothing more we can do at shutdown
+
+    async def _reserve_ids(self):
+        """Take the next PERSIST_ID_BLOCK message ids for this process."""
+        size = self.id_block
+        async with self.session_factory() as db:
+            while True:
+                # Atomic on every backend: concurrent workers get disjoint blocks
+                end = (await db.execute(
+                    update(IdSequence)
+                    .where(IdSequence.name == "messages")
+                    .values(next_value=IdSequence.next_value + size)
+                    .returning(IdSequence.next_value)
+                )).scalar()
+                if end is not None:
+                    await db.commit()
+                    break
+                # First reservation ever: continue after the existing messages
+                start = (await db.execute(select(func.max(Message.id)))).scalar() or 0
+                try:
+                    await db.execute(insert(IdSequence).values(name="messages", next_value=start + 1 + size))
+                    await db.commit()
+                    end = start + 1 + size
+                    break
+                except IntegrityError:
+                    await db.rollback()  # Another worker seeded it first
+        self._next_id = end - size
+        self._last_id = end - 1
+
+    async def create(self, username: str, content: str | None, image: str | None,
+                     room_id: str = DEFAULT_ROOM) -> Message:
+        """Build a message with its final id and timestamp, without writing it.
+
+        Only touches the database when the reserved id block is used up.
+        """
+        if self._next_id is None:
+            raise RuntimeError("MessageWriter.start() has not been called")
+        if self._next_id > self._last_id:
+            async with self._id_lock:
+                if self._next_id > self._last_id:
+                    await self._reserve_ids()
+        message = Message(
+            id=self._next_id,
+            room_id=room_id,
+            username=username,
+            content=content,
+            image=image,
+            created_at=datetime.utcnow(),
+        )
+        self._next_id += 1
+        return message
+
+    async def submit(self, message: Message):
+        """Persist a message according to the durability mode."""
+        row = {
+            "id": message.id,
+            "room_id": message.room_id,
+            "username": message.username,
+            "content": message.content,
+            "image": message.image,
+            "created_at": message.created_at,
+        }
+        if self.mode == "sync":
+            await self._write([row])
+            return
+
+        if len(self._queue) >= self.max_queue:
+            if self.mode == "best_effort":
+                self.dropped += 1
+                PERSIST_DROPPED.inc()
+                return
+            # Backpressure: the sender waits until a batch has been written
+            await self.flush()
+        self._queue.append(row)
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        """Write up to one batch of queued messages."""
+        async with self._lock:
+            if not self._queue:
+                return
+            count = min(len(self._queue), self.batch_size)
+            batch = [self._queue.popleft() for _ in range(count)]
+            try:
+                await self._write(batch)
+            except Exception:
+                if self.mode == "best_effort":
+                    self.dropped += len(batch)
+                    PERSIST_DROPPED.inc(amount=len(batch))
+                    raise
+                await self._write_rows(batch)
+
+    async def _write_rows(self, rows: list[dict]):
+        """Write a failed batch one row at a time so a single bad row cannot block the rest.
+
+        Rows the database rejects are dropped and counted. Any other error
+        (e.g. the database is down) puts the unwritten rows back in order to be
+        retried first, and is re-raised.
+        """
+        for index, row in enumerate(rows):
+            try:
+                await self._write([row])
+            except IntegrityError:
+                self.rejected += 1
+                PERSIST_REJECTED.inc()
+                ERRORS.inc("persist_rejected")
+            except Exception:
+                self._queue.extendleft(reversed(rows[index:]))
+                raise
+
+    async def _write(self, rows: list[dict]):
+        started = time.perf_counter()
+        async with self.session_factory() as db:
+            await db.execute(insert(Message), rows)
+            await db.commit()
+        COMMIT_SECONDS.observe(since(started))
+        PERSISTED.inc(amount=len(rows))
+
+    async def _flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                while self._queue:
+                    await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                ERRORS.inc("persist_flush")
+                await asyncio.sleep(self.flush_interval * 10)  # Back off before retrying
@@ -0,0 +1,166 @@
+"""Room presence shared by every worker.
+
+Each worker tracks which of its users are in which room and publishes the
+changes over the backplane in one batched event per PRESENCE_TICK, so every
+worker knows the full online list. Clients receive a `presence_snapshot` when
+they connect, followed by versioned `presence` deltas:
+
+    {"type": "presence_snapshot", "room": "general", "version": 7, "users": [...]}
+    {"type": "presence", "room": "general", "version": 8, "joined": [...], "left": [...]}
+
+A client that sees a version gap asks for a new snapshot with
+{"type": "presence_sync"}. Joins and leaves that cancel out within a tick
+(e.g. a reconnect) are never sent at all.
+
+Every worker also publishes a heartbeat each PRESENCE_HEARTBEAT. Users of a
+worker that has not been heard from for PRESENCE_INSTANCE_TTL (it crashed or
+lost the backplane) are expired and sent as normal leaves; if it is heard from
+again, it is asked to publish its users once more.
+"""
+
+import os
+import uuid
+from dotenv import load_dotenv
+
+from app.core.serializer import encode
+
+# Load environment variables from .env file
+load_dotenv()
+
+PRESENCE_TICK = float(os.getenv("PRESENCE_TICK", "1"))  # Seconds between presence deltas
+PRESENCE_HEARTBEAT = float(os.getenv("PRESENCE_HEARTBEAT", "5"))  # Seconds between worker heartbeats
+# Seconds without any event from a worker before its users are expired
+PRESENCE_INSTANCE_TTL = float(os.getenv("PRESENCE_INSTANCE_TTL", "15"))
+
+
+class Presence:
+    """Online users per room, with per-room versions and batched deltas."""
+
+    def __init__(self, instance_id: str | None = None, instance_ttl: float = PRESENCE_INSTANCE_TTL):
+        # Identifies this worker on the backplane so it can skip its own events
+        self.instance_id = instance_id or uuid.uuid4().hex
+        self.instance_ttl = instance_ttl
+        self._seen: dict[str, float] = {}  # Other worker -> when it was last heard from
+        self._expired: set[str] = set()  # Workers whose users were expired
+        self.versions: dict[str, int] = {}
+        self._rooms: dict[str, dict[str, set[str]]] = {}  # room -> username -> instances
+        # room -> username -> online state before its first change in this tick
+        self._changed: dict[str, dict[str, bool]] = {}
+        # Local joins/leaves not yet published: (room, username) -> online
+        self._outgoing: dict[tuple[str, str], bool] = {}
+
+    def users(self, room: str) -> list[str]:
+        return list(self._rooms.get(room, ()))
+
+    def all_users(self) -> set[str]:
+        online = set()
+        for users in self._rooms.values():
+            online.update(users)
+        return online
+
+    def _set(self, room: str, username: str, instance: str, online: bool):
+        users = self._rooms.setdefault(room, {})
+        was_online = username in users
+        if online:
+            users.setdefault(username, set()).add(instance)
+        elif was_online:
+            instances = users[username]
+            instances.discard(instance)
+            if not instances:
+                del users[username]
+        if not users:
+            del self._rooms[room]
+        self._changed.setdefault(room, {}).setdefault(username, was_online)
+
+    def local_join(self, room: str, username: str):
+        """A user's first connection to `room` on this worker."""
+        self._set(room, username, self.instance_id, True)
+        self._outgoing[(room, username)] = True
+
+    def local_leave(self, room: str, username: str):
+        """A user's last connection to `room` on this worker closed."""
+        self._set(room, username, self.instance_id, False)
+        self._outgoing[(room, username)] = False
+
+    def local_state(self) -> list[list]:
+        """Every local (room, username) as changes, for workers that just started."""
+        return [
+            [room, username, True]
+            for room, users in self._rooms.items()
+            for username, instances in users.items()
+            if self.instance_id in instances
+        ]
+
+    def take_outgoing(self) -> list[list]:
+        """Local changes since the last call, to be published on the backplane."""
+        changes = [[room, username, online] for (room, username), online in self._outgoing.items()]
+        self._outgoing.clear()
+        return changes
+
+    def restore_outgoing(self, changes: list[list]):
+        """Put back changes that could not be published; newer local changes win."""
+        for room, username, online in changes:
+            self._outgoing.setdefault((room, username), online)
+
+    def heard(self, instance: str, now: float) -> bool:
+        """Record an event from a worker. True if its users had been expired."""
+        if instance == self.instance_id:
+            return False
+        self._seen[instance] = now
+        if instance in self._expired:
+            self._expired.discard(instance)
+            return True
+        return False
+
+    def expire(self, now: float) -> list[str]:
+        """Take offline the users of workers not heard from within the TTL."""
+        dead = [instance for instance, seen in self._seen.items() if now - seen > self.instance_ttl]
+        for instance in dead:
+            del self._seen[instance]
+            for room, users in list(self._rooms.items()):
+                for username, instances in list(users.items()):
+                    if instance in instances:
+                        self._set(room, username, instance, False)
+                        self._expired.add(instance)
+        return dead
+
+    def apply(self, instance: str, changes: list[list]):
+        """Apply changes published by another worker."""
+        if instance == self.instance_id:
+            return
+        for room, username, online in changes:
+            self._set(room, username, instance, online)
+
+    def snapshot(self, room: str) -> str:
+        return encode({
+            "type": "presence_snapshot",
+            "room": room,
+            "version": self.versions.get(room, 0),
+            "users": self.users(room),
+        })
+
+    def deltas(self) -> list[tuple[str, str]]:
+        """Net changes since the last call as (room, frame) pairs, one per room."""
+        frames = []
+        changed, self._changed = self._changed, {}
+        for room, before in changed.items():
+            users = self._rooms.get(room, {})
+            joined = [username for username, was_online in before.items()
+                      if not was_online and username in users]
+            left = [username for username, was_online in before.items()
+                    if was_online and username not in users]
+            if not joined and not left:
+                continue  # Changes cancelled out within the tick
+            version = self.versions.get(room, 0) + 1
+            self.versions[room] = version
+            frames.append((room, encode({
+                "type": "presence",
+                "room": room,
+                "version": version,
+                "joined": joined,
+                "left": left,
+            })))
+            if room not in self._rooms:
+                # Nobody left to hold the old version, so the room can start over
+                del self.versions[room]
+        return frames
@@ -0,0 +1,80 @@
+"""Wire protocol of the chat WebSocket.
+
+Every frame in both directions is a typed envelope: an object whose `type`
+field names the event and whose other fields are its payload.
+
+    server -> client: message, history, resume, resync, typing, presence,
+                      presence_snapshot, ping, pong, error, throttled, reconnect
+    client -> server: message, typing, ping, pong, presence_sync
+
+The server pings connections that have been silent for a while (see
+HEARTBEAT_INTERVAL in app/core/manager.py); clients answer with a pong and do
+not need to ping on their own.
+
+The encoding is chosen with the WebSocket subprotocol:
+
+    chat.v1.json     - JSON text frames (also used when no subprotocol is offered)
+    chat.v1.msgpack  - MessagePack binary frames, needs the `msgpack` package
+
+permessage-deflate is negotiated by uvicorn itself (on by default with the
+`websockets` implementation, see `--ws-per-message-deflate`).
+
+Inbound frames larger than WS_MAX_FRAME_BYTES are rejected. Run uvicorn with
+`--ws-max-size` set to the same value so oversized frames are refused while
+they are being read, instead of after they have been buffered in full.
+"""
+
+import os
+from dotenv import load_dotenv
+
+from app.core.blobs import MAX_IMAGE_BYTES
+from app.core.serializer import MSGPACK_AVAILABLE, decode, from_msgpack
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Largest legitimate frame: a base64 data URL image from older clients plus the envelope
+WS_MAX_FRAME_BYTES = int(os.getenv("WS_MAX_FRAME_BYTES", str(MAX_IMAGE_BYTES * 4 // 3 + 64 * 1024)))
+
+SUBPROTOCOL_JSON = "chat.v1.json"
+SUBPROTOCOL_MSGPACK = "chat.v1.msgpack"
+
+
+def negotiate(offered: list[str]) -> str | None:
+    """Pick the subprotocol to accept from the ones the client offered."""
+    if SUBPROTOCOL_MSGPACK in offered and MSGPACK_AVAILABLE:
+        return SUBPROTOCOL_MSGPACK
+    if SUBPROTOCOL_JSON in offered:
+        return SUBPROTOCOL_JSON
+    return None
+
+
+def parse_frame(frame: dict) -> dict:
+    """Decode a received ASGI `websocket.receive` message into an event.
+
+    Raises ValueError if the frame is too large or not a typed envelope. Plain
+    text that is not JSON is accepted as a chat message for older clients.
+    """
+    data = frame.get("bytes")
+    if data is None:
+        data = frame.get("text") or ""
+    size = len(data)
+    if isinstance(data, str) and size > WS_MAX_FRAME_BYTES // 4:
+        # Text arrives decoded; a character is up to 4 bytes of UTF-8, so only
+        # frames that could be over the limit pay for encoding
+        size = len(data.encode())
+    if size > WS_MAX_FRAME_BYTES:
+        raise ValueError("Frame too large")
+    if isinstance(data, bytes):
+        if not MSGPACK_AVAILABLE:
+            raise ValueError("Binary frames need the msgpack subprotocol")
+        event = from_msgpack(data)
+    else:
+        text = data
+        try:
+            event = decode(text)
+        except ValueError:
+            return {"type": "message", "message": text}
+    if not isinstance(event, dict) or not isinstance(event.get("type"), str):
+        raise ValueError("Frame must be an object with a type")
+    return event
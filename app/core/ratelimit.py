@@ -0,0 +1,194 @@
+"""Token-bucket rate limits for inbound WebSocket events.
+
+Each event kind (message, typing, ping) has a bucket per connection, kept on
+the Connection and checked without any I/O, and a bucket per user shared by
+all of that user's tabs. User buckets live in this process by default; with
+RATE_LIMIT_BACKEND=redis they are kept in Redis and updated by one atomic Lua
+script, so a user gets the same limit no matter how many workers they hit.
+
+Limits are written as "rate:burst": tokens refilled per second and the bucket
+size. An empty value disables that bucket.
+"""
+
+import os
+import time
+from dotenv import load_dotenv
+
+from app.core.backplane import REDIS_URL
+from app.core.metrics import ERRORS, Counter
+
+# Load environment variables from .env file
+load_dotenv()
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # memory | redis
+RATE_LIMIT_PREFIX = os.getenv("RATE_LIMIT_PREFIX", "chat:ratelimit:")  # Redis key prefix
+
+THROTTLED = Counter("chat_throttled_total", "Inbound events over their rate limit, by event type", ("event",))
+
+
+def parse_limit(spec: str) -> tuple[float, float] | None:
+    """Parse "rate:burst" into (rate, burst); None when the limit is disabled."""
+    if not spec.strip():
+        return None
+    rate, _, burst = spec.partition(":")
+    rate, burst = float(rate), float(burst or rate)
+    if rate <= 0 or burst < 1:
+        raise ValueError(f"Invalid rate limit {spec!r}: rate must be > 0 and burst >= 1")
+    return rate, burst
+
+
+# Every frame, whatever its type; exceeding it pauses reading from the socket
+FRAME_LIMIT = parse_limit(os.getenv("RATE_FRAME_CONNECTION", "20:40"))
+CONNECTION_LIMITS = {
+    "message": parse_limit(os.getenv("RATE_MESSAGE_CONNECTION", "3:10")),
+    "typing": parse_limit(os.getenv("RATE_TYPING_CONNECTION", "2:5")),
+    "ping": parse_limit(os.getenv("RATE_PING_CONNECTION", "1:5")),
+}
+USER_LIMITS = {
+    "message": parse_limit(os.getenv("RATE_MESSAGE_USER", "5:20")),
+    "typing": parse_limit(os.getenv("RATE_TYPING_USER", "4:10")),
+    "ping": parse_limit(os.getenv("RATE_PING_USER", "2:10")),
+}
+
+# KEYS[1] = bucket; ARGV = rate, burst. Uses the Redis clock so workers with
+# skewed clocks share one timeline. Returns the wait as a string because Lua
+# numbers are truncated to integers in replies.
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+def take(buckets: dict, key, limit: tuple[float, float], now: float) -> float:
+    """Take a token from `buckets[key]`.
+
+    Returns 0 if one was available, otherwise the seconds until there is one.
+    A bucket is a [tokens, updated] list, created full on first use.
+    """
+    rate, burst = limit
+    bucket = buckets.get(key)
+    if bucket is None:
+        buckets[key] = [burst - 1, now]
+        return 0.0
+    tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    if tokens >= 1:
+        bucket[0] = tokens - 1
+        return 0.0
+    bucket[0] = tokens
+    return (1 - tokens) / rate
+
+
+class MemoryStore:
+    """User buckets in this process; only limits users per worker."""
+
+    PRUNE_EVERY = 60.0  # Seconds between sweeps of refilled buckets
+
+    def __init__(self):
+        self._buckets: dict[str, list[float]] = {}
+        self._limits: dict[str, tuple[float, float]] = {}
+        self._pruned = time.monotonic()
+
+    async def hit(self, key: str, limit: tuple[float, float]) -> float:
+        now = time.monotonic()
+        if now - self._pruned > self.PRUNE_EVERY:
+            self._prune(now)
+        self._limits[key] = limit
+        return take(self._buckets, key, limit, now)
+
+    def _prune(self, now: float):
+        # A bucket that has refilled completely is the same as no bucket
+        for key, (tokens, updated) in list(self._buckets.items()):
+            rate, burst = self._limits[key]
+            if tokens + (now - updated) * rate >= burst:
+                del self._buckets[key]
+                del self._limits[key]
+        self._pruned = now
+
+
+class RedisStore:
+    """User buckets in Redis, shared by every worker.
+
+    Fails open: if Redis is unreachable the event is allowed and counted in
+    chat_errors_total, since the per-connection limits still apply.
+    """
+
+    def __init__(self, client, prefix: str = RATE_LIMIT_PREFIX):
+        self.prefix = prefix
+        self._script = client.register_script(TOKEN_BUCKET_LUA)
+
+    async def hit(self, key: str, limit: tuple[float, float]) -> float:
+        try:
+            wait = await self._script(keys=[self.prefix + key], args=list(limit))
+        except Exception:
+            ERRORS.inc("ratelimit")
+            return 0.0
+        return float(wait)
+
+
+class RateLimiter:
+    def __init__(self, store: MemoryStore | RedisStore | None = None):
+        self.store = store or MemoryStore()
+
+    def frame_delay(self, buckets: dict) -> float:
+        """Seconds to stop reading before handling a connection's next frame.
+
+        Every frame is charged, going into debt if needed, so a flooding client
+        is paced to exactly the frame rate while its TCP window fills up.
+        """
+        if FRAME_LIMIT is None:
+            return 0.0
+        rate, burst = FRAME_LIMIT
+        now = time.monotonic()
+        bucket = buckets.get("frame")
+        if bucket is None:
+            bucket = buckets["frame"] = [burst, now]
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate) - 1
+        bucket[1] = now
+        if bucket[0] >= 0:
+            return 0.0
+        THROTTLED.inc("frame")
+        return -bucket[0] / rate
+
+    async def check(self, buckets: dict, username: str, kind: str) -> float:
+        """Spend one `kind` event of a connection and its user.
+
+        Returns 0 if allowed, otherwise the seconds to wait before retrying.
+        The cheap local bucket is checked first, so floods never reach Redis.
+        """
+        wait = 0.0
+        limit = CONNECTION_LIMITS.get(kind)
+        if limit is not None:
+            wait = take(buckets, kind, limit, time.monotonic())
+        limit = USER_LIMITS.get(kind)
+        if not wait and limit is not None:
+            wait = await self.store.hit(f"{username}:{kind}", limit)
+        if wait:
+            THROTTLED.inc(kind)
+        return wait
+
+
+def create_rate_limiter() -> RateLimiter:
+    """Build the rate limiter selected by RATE_LIMIT_BACKEND."""
+    if RATE_LIMIT_BACKEND == "memory":
+        return RateLimiter(MemoryStore())
+    if RATE_LIMIT_BACKEND == "redis":
+        import redis.asyncio as redis  # Optional dependency: pip install redis
+
+        return RateLimiter(RedisStore(redis.from_url(REDIS_URL)))
+    raise ValueError("RATE_LIMIT_BACKEND must be one of memory, redis")
@@ -0,0 +1,300 @@
+"""Message retention, archival and SQLite space reclamation.
+
+A background task periodically removes messages past their room's age or
+count limit:
+
+    RETENTION_MAX_AGE_DAYS   - delete messages older than this (0 = keep)
+    RETENTION_MAX_MESSAGES   - keep only the newest N per room (0 = keep all)
+    RETENTION_ROOMS          - per-room overrides, "room:days:count,..."
+                               e.g. "general:30:100000,dev:7:0"
+
+Rows are removed in small batches, each in its own short transaction with a
+pause in between, so live chat never waits long for the write lock. The FTS
+delete trigger keeps the search index in sync.
+
+Every worker runs the loop, but only the holder of the `retention` row in
+`job_leases` does the work. The holder renews it before each room, and another
+worker takes over once it has not been renewed for two intervals.
+
+With RETENTION_ARCHIVE_DIR set, each batch is first appended to gzip segment
+files, one per room and day (`<dir>/<room>/<YYYY-MM-DD>.jsonl.gz`). Every append
+is a new gzip member, so segments are append-only and stay readable as a
+whole; `read_archive` pages through them for `GET /messages`. Next to each
+segment, `<YYYY-MM-DD>.ids` lists its message ids, so a page cursor is found
+without decompressing anything but its own segment and the older ones.
+
+On SQLite, freed pages are returned to the filesystem with
+`PRAGMA incremental_vacuum` after each run. That needs auto_vacuum=INCREMENTAL,
+which new databases get from database.py; convert an existing one with:
+    python -m scripts.retention --enable-incremental-vacuum
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+import gzip
+import json
+import os
+import uuid
+from dotenv import load_dotenv
+from sqlalchemy import and_, delete, insert, or_, select, text, update
+from sqlalchemy.exc import IntegrityError
+
+from app.core.database import ReadSessionLocal, SessionLocal, engine
+from app.core.metrics import ERRORS, Counter
+from app.models.message import JobLease, Message
+
+# Load environment variables from .env file
+load_dotenv()
+
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))  # Seconds between runs; 0 disables
+RETENTION_MAX_AGE_DAYS = float(os.getenv("RETENTION_MAX_AGE_DAYS", "0"))
+RETENTION_MAX_MESSAGES = int(os.getenv("RETENTION_MAX_MESSAGES", "0"))
+RETENTION_ROOMS = os.getenv("RETENTION_ROOMS", "")
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))  # Rows per delete transaction
+RETENTION_BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", "0.05"))  # Seconds between batches
+RETENTION_ARCHIVE_DIR = os.getenv("RETENTION_ARCHIVE_DIR", "")  # Empty = delete without archiving
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "2000"))  # Pages freed per run
+
+LEASE_NAME = "retention"
+LEASE_TTL = timedelta(seconds=2 * RETENTION_INTERVAL)  # Renewed every run, so the holder keeps it
+INSTANCE_ID = uuid.uuid4().hex  # Lease holder id of this process
+
+DELETED = Counter("chat_retention_deleted_total", "Messages removed by the retention job")
+ARCHIVED = Counter("chat_retention_archived_total", "Messages written to archive segments")
+
+
+def parse_room_limits(spec: str) -> dict[str, tuple[float, int]]:
+    """Parse "room:days:count,..." into {room: (max_age_days, max_messages)}."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        room, days, count = item.split(":")
+        limits[room] = (float(days), int(count))
+    return limits
+
+
+ROOM_LIMITS = parse_room_limits(RETENTION_ROOMS)
+
+
+def room_limits(room: str) -> tuple[float, int]:
+    return ROOM_LIMITS.get(room, (RETENTION_MAX_AGE_DAYS, RETENTION_MAX_MESSAGES))
+
+
+def _row(msg: Message) -> dict:
+    return {
+        "id": msg.id,
+        "room_id": msg.room_id,
+        "username": msg.username,
+        "content": msg.content,
+        "image": msg.image,
+        "created_at": msg.created_at.isoformat(),
+    }
+
+
+def _segment_dir(room: str) -> str:
+    return os.path.join(RETENTION_ARCHIVE_DIR, room)
+
+
+def _key(row: dict) -> tuple[str, int]:
+    return row["created_at"], row["id"]
+
+
+def _segment_ids(directory: str, name: str) -> set[int] | None:
+    """Ids archived in a segment, or None if it has no id index."""
+    path = os.path.join(directory, name.removesuffix(".jsonl.gz") + ".ids")
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return {int(line) for line in f if line.strip()}
+
+
+def archive_rows(room: str, rows: list[dict]):
+    """Append rows to their day segments and fsync before they are deleted."""
+    by_day: dict[str, list[dict]] = {}
+    for row in rows:
+        by_day.setdefault(row["created_at"][:10], []).append(row)
+    os.makedirs(_segment_dir(room), exist_ok=True)
+    for day, day_rows in by_day.items():
+        data = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in day_rows)
+        with open(os.path.join(_segment_dir(room), f"{day}.jsonl.gz"), "ab") as f:
+            f.write(gzip.compress(data.encode()))
+            f.flush()
+            os.fsync(f.fileno())
+        # Written after the rows: a crash in between leaves them in the table, to be archived again
+        with open(os.path.join(_segment_dir(room), f"{day}.ids"), "a", encoding="utf-8") as f:
+            f.write("".join(f"{row['id']}\n" for row in day_rows))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def read_archive(room: str, before: int | None = None, limit: int = 50) -> list[Message]:
+    """Archived messages of a room, newest first, older than archived message `before`.
+
+    Archived rows are always older than the rows still in the database, so
+    when `before` is not in the archive the newest archived rows are returned.
+    """
+    directory = _segment_dir(room)
+    if not RETENTION_ARCHIVE_DIR or not os.path.isdir(directory):
+        return []
+    # Newest day first; older segments only hold older rows
+    names = sorted((name for name in os.listdir(directory) if name.endswith(".jsonl.gz")), reverse=True)
+    if before is not None:
+        # Start at the cursor's segment; one without an index has to be read to know
+        for start, name in enumerate(names):
+            ids = _segment_ids(directory, name)
+            if ids is None or before in ids:
+                names = names[start:]
+                break
+        else:
+            before = None  # Not archived, e.g. the oldest row still in the table
+    rows: dict[int, dict] = {}
+    key = None
+    # Stop once the page is full below the cursor
+    for name in names:
+        with gzip.open(os.path.join(directory, name), "rt", encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                rows[row["id"]] = row  # A rerun after a crash may have archived a row twice
+        if before is not None and key is None:
+            if before not in rows:
+                continue  # Cursor is in an older segment, or not archived at all
+            key = _key(rows[before])
+        if sum(1 for row in rows.values() if key is None or _key(row) < key) >= limit:
+            break
+    older = sorted(
+        (row for row in rows.values() if key is None or _key(row) < key),
+        key=_key,
+        reverse=True,
+    )[:limit]
+    return [
+        Message(**{**row, "created_at": datetime.fromisoformat(row["created_at"])})
+        for row in older
+    ]
+
+
+async def _count_cutoff(room: str, keep: int):
+    """(created_at, id) of the newest row past the newest `keep`, or None."""
+    async with ReadSessionLocal() as db:
+        result = await db.execute(
+            select(Message.created_at, Message.id)
+            .where(Message.room_id == room)
+            .order_by(Message.created_at.desc(), Message.id.desc())
+            .offset(keep)
+            .limit(1)
+        )
+        return result.first()
+
+
+async def _purge_room(room: str, now: datetime) -> int:
+    """Delete (and archive) one room's expired messages in batches. Returns the count."""
+    max_age_days, max_messages = room_limits(room)
+    conditions = []
+    if max_age_days > 0:
+        conditions.append(Message.created_at < now - timedelta(days=max_age_days))
+    if max_messages > 0:
+        cutoff = await _count_cutoff(room, max_messages)
+        if cutoff is not None:
+            conditions.append(or_(
+                Message.created_at < cutoff.created_at,
+                and_(Message.created_at == cutoff.created_at, Message.id <= cutoff.id),
+            ))
+    if not conditions:
+        return 0
+
+    removed = 0
+    while True:
+        async with SessionLocal() as db:
+            result = await db.execute(
+                select(Message)
+                .where(Message.room_id == room, or_(*conditions))
+                .order_by(Message.created_at, Message.id)
+                .limit(RETENTION_BATCH_SIZE)
+            )
+            batch = result.scalars().all()
+            if not batch:
+                return removed
+            if RETENTION_ARCHIVE_DIR:
+                await asyncio.to_thread(archive_rows, room, [_row(msg) for msg in batch])
+                ARCHIVED.inc(amount=len(batch))
+            await db.execute(delete(Message).where(Message.id.in_([msg.id for msg in batch])))
+            await db.commit()
+        removed += len(batch)
+        DELETED.inc(amount=len(batch))
+        if len(batch) < RETENTION_BATCH_SIZE:
+            return removed
+        await asyncio.sleep(RETENTION_BATCH_PAUSE)  # Let live writes take the lock
+
+
+async def incremental_vacuum(pages: int = RETENTION_VACUUM_PAGES):
+    """Return up to `pages` free SQLite pages to the filesystem; no-op elsewhere."""
+    if engine.dialect.name != "sqlite":
+        return
+    async with engine.connect() as conn:
+        mode = (await conn.execute(text("PRAGMA auto_vacuum"))).scalar()
+        if mode == 2:  # INCREMENTAL
+            # A plain execute steps the pragma once and frees a single page;
+            # executescript runs it to completion
+            raw = await conn.get_raw_connection()
+            await raw.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+
+
+async def acquire_lease() -> bool:
+    """Take or renew the retention lease. True if this process holds it."""
+    now = datetime.utcnow()
+    async with SessionLocal() as db:
+        result = await db.execute(
+            update(JobLease)
+            .where(JobLease.name == LEASE_NAME,
+                   or_(JobLease.holder == INSTANCE_ID, JobLease.expires_at < now))
+            .values(holder=INSTANCE_ID, expires_at=now + LEASE_TTL)
+        )
+        if result.rowcount:
+            await db.commit()
+            return True
+        try:
+            await db.execute(insert(JobLease).values(name=LEASE_NAME, holder=INSTANCE_ID,
+                                                     expires_at=now + LEASE_TTL))
+            await db.commit()
+            return True
+        except IntegrityError:
+            await db.rollback()  # Held by another worker
+            return False
+
+
+async def run_once(now: datetime | None = None, leased: bool = False) -> int:
+    """One retention pass over every room. Returns the number of messages removed.
+
+    With `leased`, the pass stops as soon as the lease can not be renewed.
+    """
+    now = now or datetime.utcnow()
+    async with ReadSessionLocal() as db:
+        rooms = (await db.execute(select(Message.room_id).distinct())).scalars().all()
+    removed = 0
+    for room in rooms:
+        if leased and not await acquire_lease():
+            break  # Another worker took over
+        removed += await _purge_room(room, now)
+    if removed:
+        await incremental_vacuum()
+    return removed
+
+
+def enabled() -> bool:
+    """Whether the retention loop should be started; the lease picks the worker."""
+    has_limits = RETENTION_MAX_AGE_DAYS > 0 or RETENTION_MAX_MESSAGES > 0 or any(
+        days > 0 or count > 0 for days, count in ROOM_LIMITS.values()
+    )
+    return RETENTION_INTERVAL > 0 and has_limits
+
+
+async def run_forever(interval: float = RETENTION_INTERVAL):
+    """Background retention loop, started from the app lifespan."""
+    async with engine.begin() as conn:
+        # Databases created before the lease existed get the table here
+        await conn.run_sync(lambda sync_conn: JobLease.__table__.create(sync_conn, checkfirst=True))
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await acquire_lease():
+                await run_once(leased=True)
+        except Exception:
+            ERRORS.inc("retention")  # Retried on the next run
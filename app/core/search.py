@@ -0,0 +1,112 @@
+"""Full-text search over chat messages.
+
+SQLite uses an external-content FTS5 table kept in sync with `messages` by
+triggers, so batched inserts and deletes are indexed without application code.
+Postgres uses a GIN expression index on the message tsvector instead.
+
+Both are created together with the tables by init_db; existing databases are
+indexed with:
+    python -m scripts.backfill_search
+"""
+
+import html
+import re
+from datetime import datetime
+from sqlalchemy import DDL, and_, event, func, literal_column, select, table, column
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.message import Message
+
+# Never appear in chat text; replaced by <mark> after the snippet is HTML-escaped
+_MARK_START, _MARK_END = "\x02", "\x03"
+SNIPPET_TOKENS = 12
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+# Rebuilds the whole FTS index from the messages table in one pass
+SQLITE_REBUILD = "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"
+
+# The query below must use exactly this expression for the index to apply
+POSTGRES_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_messages_content_fts ON messages "
+    "USING GIN (to_tsvector('simple', coalesce(content, '')))",
+]
+
+for _statement in SQLITE_DDL:
+    event.listen(Message.__table__, "after_create", DDL(_statement).execute_if(dialect="sqlite"))
+for _statement in POSTGRES_DDL:
+    event.listen(Message.__table__, "after_create", DDL(_statement).execute_if(dialect="postgresql"))
+
+_fts = table("messages_fts", column("rowid"))
+_fts_ref = literal_column("messages_fts")
+_pg_vector = func.to_tsvector(literal_column("'simple'"), func.coalesce(Message.content, literal_column("''")))
+
+
+def fts5_query(text: str) -> str | None:
+    """Turn free text into a safe FTS5 query: every word must match, the last as a prefix."""
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def _highlight(snippet: str) -> str:
+    return html.escape(snippet).replace(_MARK_START, "<mark>").replace(_MARK_END, "</mark>")
+
+
+async def search_messages(db: AsyncSession, text: str, username: str | None = None,
+                          room: str | None = None, since: datetime | None = None,
+                          until: datetime | None = None, limit: int = 20,
+                          offset: int = 0) -> list[tuple[Message, str, float]]:
+    """Best matches first, as (message, HTML-safe snippet with <mark> tags, score).
+
+    Higher scores are better on both engines.
+    """
+    filters = []
+    if username is not None:
+        filters.append(Message.username == username)
+    if room is not None:
+        filters.append(Message.room_id == room)
+    if since is not None:
+        filters.append(Message.created_at >= since)
+    if until is not None:
+        filters.append(Message.created_at < until)
+
+    if db.bind.dialect.name == "postgresql":
+        tsquery = func.websearch_to_tsquery(literal_column("'simple'"), text)
+        rank = func.ts_rank(_pg_vector, tsquery)
+        snippet = func.ts_headline(
+            literal_column("'simple'"), func.coalesce(Message.content, literal_column("''")), tsquery,
+            f"StartSel={_MARK_START}, StopSel={_MARK_END}, MaxWords={SNIPPET_TOKENS}, MinWords=3",
+        )
+        query = (
+            select(Message, snippet, rank)
+            .where(_pg_vector.op("@@")(tsquery), *filters)
+            .order_by(rank.desc(), Message.id.desc())
+        )
+    else:
+        match = fts5_query(text)
+        if match is None:
+            return []
+        rank = -func.bm25(_fts_ref)  # bm25 is lower-is-better
+        snippet = func.snippet(_fts_ref, 0, _MARK_START, _MARK_END, "…", SNIPPET_TOKENS)
+        query = (
+            select(Message, snippet, rank)
+            .join(_fts, _fts.c.rowid == Message.id)
+            .where(and_(_fts_ref.op("MATCH")(match), *filters))
+            .order_by(rank.desc(), Message.id.desc())
+        )
+
+    result = await db.execute(query.limit(limit).offset(offset))
+    return [(msg, _highlight(snip or ""), float(score)) for msg, snip, score in result.all()]
@@ -1,9 +1,19 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
+import asyncio
+import base64
 import bcrypt
+import hashlib
+import hmac
 import os
+import time
+import warnings
 from dotenv import load_dotenv
 
+from app.core.metrics import Gauge, Histogram
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -11,6 +21,14 @@ SECRET_KEY = os.getenv("SECRET_KEY", "super_secret_key_change_this_in_production
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "1440"))
 SALT_ROUNDS = int(os.getenv("SALT_ROUNDS", "12"))  # Number of rounds for bcrypt
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "4"))  # Threads running bcrypt
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", "64"))  # Max hash jobs waiting for a thread
+JWT_BACKEND = os.getenv("JWT_BACKEND", "jose")  # jose | pyjwt
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))  # Verified tokens kept in memory
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))  # Seconds before a token is re-verified
+WS_TICKET_TTL = int(os.getenv("WS_TICKET_TTL", "30"))  # Seconds a WebSocket connect ticket is valid
+TICKET_PREFIX = "t."
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")  # Bearer token for /admin endpoints; unset disables them
 
 def hash_password(password: str) -> str:
     if len(password.encode()) > 72:
@@ -28,6 +46,95 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     except ValueError:
         return False  # Password too long or invalid format
 
+def needs_rehash(hashed_password: str) -> bool:
+    """True if the hash was made with a different cost than SALT_ROUNDS."""
+    try:
+        return int(hashed_password.split("$")[2]) != SALT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+
+HASH_WAIT_SECONDS = Histogram("chat_hash_wait_seconds", "Time password hashes wait for a bcrypt thread")
+HASH_POOL = Gauge("chat_hash_pool", "bcrypt worker pool state", ("stat",))
+
+
+class HashPoolBusy(Exception):
+    """Raised when too many password hashes are already waiting for a worker."""
+
+
+class HashPool:
+    """Bounded thread pool for bcrypt so hashing never blocks the event loop.
+
+    bcrypt releases the GIL while it works, so threads give real parallelism.
+    At most `queue_limit` jobs may wait for a free thread; beyond that callers
+    get HashPoolBusy instead of piling up behind a login burst.
+    """
+
+    def __init__(self, workers: int = HASH_WORKERS, queue_limit: int = HASH_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.max_wait_seconds = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+
+    @property
+    def queued(self) -> int:
+        """Jobs submitted but not yet picked up by a thread."""
+        return max(self.in_flight - self.workers, 0)
+
+    async def run(self, fn, *args):
+        if self.queued >= self.queue_limit:
+            self.rejected += 1
+            raise HashPoolBusy("Server is busy, please retry")
+
+        submitted = time.perf_counter()
+        started = submitted
+
+        def job():
+            nonlocal started
+            started = time.perf_counter()
+            return fn(*args)
+
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, job)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            waited = started - submitted
+            HASH_WAIT_SECONDS.observe(waited)
+            self.wait_seconds_total += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "wait_seconds_total": self.wait_seconds_total,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+
+hash_pool = HashPool()
+HASH_POOL.set_function(lambda: {(stat,): value for stat, value in hash_pool.stats().items()})
+
+
+async def hash_password_async(password: str) -> str:
+    """hash_password on the bcrypt worker pool."""
+    return await hash_pool.run(hash_password, password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """verify_password on the bcrypt worker pool."""
+    return await hash_pool.run(verify_password, plain_password, hashed_password)
+
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
@@ -35,17 +142,138 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+
+def _load_decoder(name: str):
+    """Return a decode(token) callable for the configured JWT backend."""
+    if name == "pyjwt":
+        try:
+            import jwt as pyjwt
+        except ImportError:
+            warnings.warn("JWT_BACKEND=pyjwt but PyJWT is not installed, using python-jose")
+        else:
+            def pyjwt_decode(token: str) -> dict | None:
+                try:
+                    return pyjwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+                except pyjwt.PyJWTError:
+                    return None
+            return pyjwt_decode
+    elif name != "jose":
+        raise ValueError("JWT_BACKEND must be jose or pyjwt")
+
+    def jose_decode(token: str) -> dict | None:
+        try:
+            return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            return None
+    return jose_decode
+
+
+_decode = _load_decoder(JWT_BACKEND)
+
+
 def verify_token(token: str) -> dict | None:
     """Verify JWT token and return payload if valid, None otherwise."""
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
-    except JWTError:
-        return None
+    return _decode(token)
+
+
+class TokenCache:
+    """LRU cache of verified tokens, so reconnects skip signature checks.
+
+    Entries are keyed by the SHA-256 of the token (raw tokens are never kept)
+    and expire at the token's `exp` or after `ttl` seconds, whichever is first.
+    Invalid tokens are never cached.
+    """
+
+    def __init__(self, size: int = TOKEN_CACHE_SIZE, ttl: float = TOKEN_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[bytes, tuple[str, float]] = OrderedDict()
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> str | None:
+        key = self._key(token)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        username, expires = entry
+        if expires <= time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return username
+
+    def put(self, token: str, username: str, exp: float | None):
+        if self.size <= 0:
+            return
+        expires = time.time() + self.ttl
+        if exp is not None:
+            expires = min(expires, exp)
+        key = self._key(token)
+        self._entries[key] = (username, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+token_cache = TokenCache()
+
 
 def get_username_from_token(token: str) -> str | None:
     """Extract username from JWT token."""
+    username = token_cache.get(token)
+    if username is not None:
+        return username
     payload = verify_token(token)
-    if payload:
-        return payload.get("sub")
+    if payload and payload.get("sub"):
+        token_cache.put(token, payload["sub"], payload.get("exp"))
+        return payload["sub"]
     return None
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _unb64(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _ticket_signature(body: str) -> str:
+    return _b64(hmac.new(SECRET_KEY.encode(), b"ws-ticket:" + body.encode(), hashlib.sha256).digest())
+
+
+def create_ws_ticket(username: str) -> str:
+    """Short-lived WebSocket connect ticket: `t.<username>.<expiry>.<hmac>`.
+
+    A single HMAC is far cheaper to check than a JWT, and the long-lived access
+    token no longer ends up in WebSocket URLs (and in access logs).
+    """
+    body = f"{TICKET_PREFIX}{_b64(username.encode())}.{int(time.time()) + WS_TICKET_TTL}"
+    return f"{body}.{_ticket_signature(body)}"
+
+
+def get_username_from_ticket(ticket: str) -> str | None:
+    """Username from a valid, unexpired connect ticket, None otherwise."""
+    if not ticket.startswith(TICKET_PREFIX):
+        return None
+    body, _, signature = ticket.rpartition(".")
+    if not hmac.compare_digest(signature, _ticket_signature(body)):
+        return None
+    try:
+        encoded_username, expires = body[len(TICKET_PREFIX):].split(".")
+        if int(expires) < time.time():
+            return None
+        return _unb64(encoded_username).decode()
+    except ValueError:
+        return None
@@ -0,0 +1,86 @@
+"""Serialization layer for WebSocket events.
+
+Every outbound frame goes through `encode`, so an event is serialized exactly
+once and the resulting string is shared by all recipients. A faster backend
+can be selected with JSON_BACKEND=orjson or JSON_BACKEND=msgspec.
+
+Clients that negotiate the MessagePack subprotocol get the same events as
+binary frames; `to_msgpack` converts an encoded JSON frame once per fan-out.
+MessagePack support needs the optional `msgpack` package.
+"""
+
+import json
+import os
+import warnings
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+JSON_BACKEND = os.getenv("JSON_BACKEND", "json")  # json | orjson | msgspec
+
+
+def _json_encode(data) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def _load_backend(name: str):
+    """Return (encode, decode) callables for the configured backend."""
+    if name == "orjson":
+        try:
+            import orjson
+        except ImportError:
+            warnings.warn("JSON_BACKEND=orjson but orjson is not installed, using json")
+        else:
+            return (lambda data: orjson.dumps(data).decode()), orjson.loads
+    elif name == "msgspec":
+        try:
+            import msgspec
+        except ImportError:
+            warnings.warn("JSON_BACKEND=msgspec but msgspec is not installed, using json")
+        else:
+            encoder, decoder = msgspec.json.Encoder(), msgspec.json.Decoder()
+
+            def msgspec_decode(data):
+                try:
+                    return decoder.decode(data)
+                except msgspec.DecodeError as e:
+                    raise ValueError(str(e)) from e
+
+            return (lambda data: encoder.encode(data).decode()), msgspec_decode
+    elif name != "json":
+        raise ValueError("JSON_BACKEND must be one of json, orjson, msgspec")
+    return _json_encode, json.loads
+
+
+_encode, _decode = _load_backend(JSON_BACKEND)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_AVAILABLE = msgpack is not None
+
+
+def encode(data: dict) -> str:
+    """Serialize an outbound event to a text frame."""
+    return _encode(data)
+
+
+def decode(data: str | bytes):
+    """Parse an inbound JSON frame. Raises ValueError on malformed input."""
+    return _decode(data)
+
+
+def to_msgpack(frame: str) -> bytes:
+    """Re-encode a JSON text frame as a MessagePack binary frame."""
+    return msgpack.packb(_decode(frame), use_bin_type=True)
+
+
+def from_msgpack(data: bytes):
+    """Parse an inbound MessagePack frame. Raises ValueError on malformed input."""
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except Exception as e:
+        raise ValueError(str(e)) from e
@@ -1,5 +1,12 @@
 """Shared state module to avoid circular imports."""
 from app.core.manager import ConnectionManager
+from app.core.backplane import create_backplane
+from app.core.history import HistoryCache
+from app.core.persistence import MessageWriter
+from app.core.ratelimit import create_rate_limiter
 
 # Create global connection manager
-manager = ConnectionManager()
\ No newline at end of file
+manager = ConnectionManager(create_backplane(), HistoryCache(), MessageWriter())
+
+# Token buckets for inbound WebSocket events
+rate_limiter = create_rate_limiter()
@@ -1,3 +1,4 @@
+import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
@@ -5,17 +6,27 @@ from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 import os
-from app.routers import chat, auth
+from app.routers import chat, auth, media, metrics, admin
 from app.core.database import Base, engine
 from app.core.state import manager
+from app.core import images, retention
+from app.core.metrics import monitor_event_loop_lag
 
 # Load environment variables at startup
 load_dotenv()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with manager.lifespan():
-        yield
+    tasks = [asyncio.create_task(monitor_event_loop_lag())]
+    if retention.enabled():
+        tasks.append(asyncio.create_task(retention.run_forever()))
+    try:
+        async with manager.lifespan():
+            yield
+    finally:
+        for task in tasks:
+            task.cancel()
+    images.shutdown()
 
 # Jadval yaratishni qo'lda amalga oshiring: async engine bilan avtomatik create_all ishlamaydi.
 # Iltimos quyidagi faylni ishga tushiring loyiha boshlanishidan oldin:
@@ -39,6 +50,9 @@ app.add_middleware(
 
 app.include_router(chat.router)
 app.include_router(auth.router)
+app.include_router(media.router)
+app.include_router(metrics.router)
+app.include_router(admin.router)
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
 @app.get("/")
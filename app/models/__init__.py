@@ -1,3 +1,3 @@
-from .message import User, Message
+from .message import User, Message, IdSequence, JobLease
 
-__all__ = ["User", "Message"]
+__all__ = ["User", "Message", "IdSequence", "JobLease"]
@@ -1,8 +1,10 @@
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, Index
 from datetime import datetime
 # Use Base from app.core.database (project uses core/database.py)
 from app.core.database import Base
 
+DEFAULT_ROOM = "general"  # Room used by /ws/{token} and for messages stored before rooms existed
+
 class User(Base):
     __tablename__ = "users"
 
@@ -14,9 +16,33 @@ class User(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Keyset pagination and "latest N" queries walk this index backwards
+        Index("ix_messages_created_at_id", "created_at", "id"),
+        # The same walk restricted to a single room
+        Index("ix_messages_room_created_at_id", "room_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
+    room_id = Column(String, nullable=False, default=DEFAULT_ROOM, server_default=DEFAULT_ROOM)
     username = Column(String, index=True)
     content = Column(String)
-    image = Column(String, nullable=True)  # Base64 encoded image or URL
+    image = Column(String, nullable=True)  # Blob URL, e.g. /media/<sha256>.png
     created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class IdSequence(Base):
+    """Next unreserved id per table; workers reserve blocks of ids from it."""
+    __tablename__ = "id_sequences"
+
+    name = Column(String, primary_key=True)
+    next_value = Column(Integer, nullable=False)
+
+
+class JobLease(Base):
+    """Which process currently runs a background job, until when."""
+    __tablename__ = "job_leases"
+
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
@@ -0,0 +1,23 @@
+from fastapi import APIRouter, Depends, status
+from app.core.deps import require_admin
+from app.core.state import manager
+
+router = APIRouter(prefix="/admin", tags=["Admin"], dependencies=[Depends(require_admin)])
+
+
+@router.post("/drain", status_code=status.HTTP_202_ACCEPTED)
+async def start_drain():
+    """Put this instance in drain mode before a deploy.
+
+    New WebSockets are refused, and open ones are flushed and closed in paced
+    batches with a jittered reconnect hint. Poll `GET /admin/drain` until the
+    state is "drained", then stop the process.
+    """
+    manager.start_drain()
+    return manager.drain_progress()
+
+
+@router.get("/drain")
+async def drain_progress():
+    """Drain state: serving, draining or drained, with connections left."""
+    return manager.drain_progress()
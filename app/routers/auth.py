@@ -3,7 +3,16 @@ from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.models import User
 from app.core.database import get_db
-from app.core.security import hash_password, verify_password, create_access_token
+from app.core.deps import get_current_username
+from app.core.security import (
+    WS_TICKET_TTL,
+    HashPoolBusy,
+    create_access_token,
+    create_ws_ticket,
+    hash_password_async,
+    needs_rehash,
+    verify_password_async,
+)
 from app.schemas.auth import UserCreate, Token
 
 router = APIRouter(prefix="/auth", tags=["Auth"])
@@ -19,12 +28,17 @@ async def register(payload: UserCreate, db: AsyncSession = Depends(get_db)):
         if existing:
             raise HTTPException(status_code=400, detail="Username already taken")
             
-        # Create new user
-        new_user = User(username=payload.username, hashed_password=hash_password(payload.password))
+        # Create new user (bcrypt runs on the worker pool, not the event loop)
+        hashed = await hash_password_async(payload.password)
+        new_user = User(username=payload.username, hashed_password=hashed)
         db.add(new_user)
         await db.commit()
         await db.refresh(new_user)
         return {"message": "User registered successfully"}
+    except HTTPException:
+        raise
+    except HashPoolBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -37,14 +51,27 @@ async def login(payload: UserCreate, db: AsyncSession = Depends(get_db)):
     try:
         result = await db.execute(select(User).where(User.username == payload.username))
         user = result.scalar_one_or_none()
-        if not user or not verify_password(payload.password, user.hashed_password):
+        if not user or not await verify_password_async(payload.password, user.hashed_password):
             raise HTTPException(status_code=401, detail="Invalid credentials")
 
+        # Transparently upgrade hashes made with an old SALT_ROUNDS setting
+        if needs_rehash(user.hashed_password):
+            user.hashed_password = await hash_password_async(payload.password)
+            await db.commit()
+
         token = create_access_token({"sub": user.username})
         return {"access_token": token, "token_type": "bearer"}
     except HTTPException:
         raise
+    except HashPoolBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail="Internal server error")
+
+
+@router.post("/ws-ticket")
+async def ws_ticket(username: str = Depends(get_current_username)):
+    """Issue a short-lived ticket for opening the chat WebSocket (`/ws/{ticket}`)."""
+    return {"ticket": create_ws_ticket(username), "expires_in": WS_TICKET_TTL}
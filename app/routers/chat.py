@@ -1,168 +1,305 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from datetime import datetime
+from fastapi import APIRouter, Depends, Query, WebSocket, WebSocketDisconnect
+from sqlalchemy import and_, or_, select
 from sqlalchemy.ext.asyncio import AsyncSession
-import json
-from app.core.database import SessionLocal
+import asyncio
+import re
+import time
+from app.core.database import SessionLocal, get_read_db
 from app.models.message import Message
-from app.core.state import manager  # Import from state module
-from app.core.security import get_username_from_token
+from app.core.state import manager, rate_limiter  # Import from state module
+from app.core.security import get_username_from_ticket, get_username_from_token
+from app.core.deps import get_current_username
+from app.core.serializer import encode
+from app.core.protocol import SUBPROTOCOL_MSGPACK, negotiate, parse_frame
+from app.core.blobs import blob_url, decode_data_url, name_from_url, parse_name, save_blob
+from app.core.images import create_variants
+from app.core.history import DEFAULT_ROOM, RESYNC_FRAME, message_payload
+from app.core.search import search_messages
+from app.core.retention import RETENTION_ARCHIVE_DIR, read_archive
+from app.core.metrics import ERRORS, Counter
 
 router = APIRouter()
 
+# Frames that never change are serialized once at import time
+PONG_FRAME = encode({"type": "pong"})
+# Exactly what JSON clients send back for a heartbeat ping; matched without decoding
+PONG_TEXT = '{"type":"pong"}'
+ROOM_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+LIMITED_EVENTS = frozenset(("message", "typing", "ping"))
+
+FRAMES_RECEIVED = Counter("chat_frames_received_total", "Inbound WebSocket frames, by event type", ("type",))
+MESSAGES_ACCEPTED = Counter("chat_messages_total", "Chat messages accepted and broadcast")
+
+
+async def resolve_image(image: str) -> str:
+    """Turn an incoming image field into a blob URL.
+
+    Uploaded images arrive as `/media/...` URLs; inline base64 data URLs from
+    older clients are moved into the blob store first.
+    """
+    if image.startswith("data:"):
+        data = decode_data_url(image)
+        name = await asyncio.to_thread(save_blob, data)
+        try:
+            await create_variants(name)
+        except Exception:
+            ERRORS.inc("image_variants")  # Serve the original only
+        return blob_url(name)
+    name = name_from_url(image)
+    if name is None or parse_name(name)[1] is not None:
+        raise ValueError("Rasm topilmadi")
+    return blob_url(name)
+
 async def get_db():
     async with SessionLocal() as session:
         yield session
 
-from sqlalchemy import select
+
+@router.get("/messages", tags=["Chat"])
+async def list_messages(
+    room: str = Query(DEFAULT_ROOM, pattern=ROOM_PATTERN.pattern),
+    before: int | None = Query(None, description="Return messages older than this message id"),
+    limit: int = Query(50, ge=1, le=100),
+    db: AsyncSession = Depends(get_read_db),
+    username: str = Depends(get_current_username),
+):
+    """Page backwards through a room's history using a keyset cursor on (created_at, id).
+
+    Pass the `next_before` value of a page as `before` to fetch the next older page.
+    Once the table runs out, pages continue from the retention archive.
+    """
+    query = select(Message).where(Message.room_id == room)
+    if before is not None:
+        # Resolve the cursor row's timestamp in the same statement
+        cursor_ts = select(Message.created_at).where(Message.id == before).scalar_subquery()
+        query = query.where(or_(
+            Message.created_at < cursor_ts,
+            and_(Message.created_at == cursor_ts, Message.id < before),
+        ))
+    result = await db.execute(
+        query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit)
+    )
+    rows = result.scalars().all()
+    if len(rows) < limit and RETENTION_ARCHIVE_DIR:
+        # Archived messages are older than anything left in the table
+        rows = [*rows, *await asyncio.to_thread(read_archive, room, None if rows else before,
+                                                 limit - len(rows))]
+    return {
+        # Oldest first, like the WebSocket history frame
+        "messages": [message_payload(msg) for msg in reversed(rows)],
+        "next_before": rows[-1].id if len(rows) == limit else None,
+    }
+
+@router.get("/messages/search", tags=["Chat"])
+async def search(
+    q: str = Query(..., min_length=1, max_length=200, description="Words to search for"),
+    username: str | None = Query(None, description="Only messages from this user"),
+    room: str | None = Query(None, pattern=ROOM_PATTERN.pattern),
+    since: datetime | None = Query(None, description="Only messages at or after this time"),
+    until: datetime | None = Query(None, description="Only messages before this time"),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=1000),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: str = Depends(get_current_username),
+):
+    """Full-text search over message text, best matches first.
+
+    Each result is a message payload plus an HTML-safe `snippet` with matches
+    wrapped in `<mark>` and its relevance `score`.
+    """
+    rows = await search_messages(db, q, username=username, room=room, since=since,
+                                 until=until, limit=limit, offset=offset)
+    return {
+        "results": [
+            {**message_payload(msg), "snippet": snippet, "score": score}
+            for msg, snippet, score in rows
+        ],
+        "next_offset": offset + limit if len(rows) == limit else None,
+    }
 
 @router.websocket("/ws/{token}")
-async def websocket_chat(websocket: WebSocket, token: str):
-    """WebSocket endpoint with JWT authentication."""
+async def websocket_default_room(websocket: WebSocket, token: str, compress: str | None = None,
+                                 since: int | None = None):
+    """WebSocket endpoint for the default room."""
+    await websocket_chat(websocket, DEFAULT_ROOM, token, compress, since)
+
+@router.websocket("/ws/{room}/{token}")
+async def websocket_chat(websocket: WebSocket, room: str, token: str, compress: str | None = None,
+                         since: int | None = None):
+    """WebSocket endpoint for one room, authenticated by a connect ticket or a JWT.
+
+    Clients should fetch a ticket from `POST /auth/ws-ticket`; a raw access
+    token is still accepted for older clients.
+
+    `?compress=deflate` lets the client receive large frames (the history
+    batch) as zlib-compressed binary frames.
+
+    `?since=<message id>` resumes a dropped session: only the messages after
+    that id are sent (`resume`), or `resync` followed by the full history if
+    the client is too far behind.
+
+    The frame encoding is negotiated by subprotocol, see app/core/protocol.py.
+    """
     username = None
-    db = None
+    conn = None
     
     try:
-        # Check if server is shutting down
-        if manager._shutdown:
-            await websocket.close(code=1001)  # Going away
+        # Check if server is shutting down or handing its clients off
+        if manager._shutdown or manager.draining:
+            await websocket.close(code=1012)  # Service restart
             return
         
-        # Verify JWT token and extract username
-        username = get_username_from_token(token)
+        if not ROOM_PATTERN.match(room):
+            await websocket.close(code=1008, reason="Invalid room")
+            return
+
+        # Cheap HMAC ticket first, then the (cached) JWT check
+        username = get_username_from_ticket(token) or get_username_from_token(token)
         if not username:
             await websocket.close(code=1008, reason="Invalid or expired token")
             return
         
         # Accept WebSocket connection
-        await manager.connect(websocket, username)
-        
-        # Create database session for this connection
-        db = SessionLocal()
+        subprotocol = negotiate(websocket.scope.get("subprotocols", []))
+        conn = await manager.connect(websocket, username, room, subprotocol)
+        # MessagePack clients rely on permessage-deflate instead of deflated JSON batches
+        compress = None if subprotocol == SUBPROTOCOL_MSGPACK else compress
         
-        try:
-            # First send history only to the new connection (limit to last 50 messages)
-            result = await db.execute(
-                select(Message).order_by(Message.created_at.desc()).limit(50)
-            )
-            old_messages = result.scalars().all()
-            
-            # Reverse to show oldest first
-            for msg in reversed(old_messages):
-                try:
-                    if manager._shutdown:
-                        break
-                    history_data = {
-                        "type": "message",
-                        "username": msg.username,
-                        "timestamp": msg.created_at.isoformat()
-                    }
-                    if msg.content:
-                        history_data["message"] = msg.content
-                        # Check if it's a sticker (single emoji character)
-                        if len(msg.content) == 1 and ord(msg.content) > 0x1F000:
-                            history_data["isSticker"] = True
-                    if msg.image:
-                        history_data["image"] = msg.image
-                    await websocket.send_json(history_data)
-                except Exception:
-                    break  # Stop if we can't send messages
-
-            while not manager._shutdown:
+        # First send history only to the new connection as a single batched frame
+        resumed = None
+        if since is not None:
+            resumed = await manager.history.resume(room, since, compress == "deflate")
+            if resumed is None:
+                manager.send(conn, RESYNC_FRAME)
+        manager.send(conn, resumed if resumed is not None else
+                     await manager.history.batch(room, compress == "deflate"))
+        # Join the room only now, without awaiting in between: anything delivered
+        # while the history was loading is already in it
+        manager.join(conn)
+        # Then who is online; later changes arrive as versioned presence deltas
+        manager.send(conn, manager.presence_snapshot(room))
+
+        while not manager._shutdown:
+            try:
+                frame = await websocket.receive()
+                if frame["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(frame.get("code", 1000))
+                conn.last_seen = time.monotonic()
+                if frame.get("text") == PONG_TEXT:
+                    continue  # Heartbeat answer; receiving it was the point
+
+                # Pause reading from a flooding client instead of queueing its work
+                delay = rate_limiter.frame_delay(conn.buckets)
+                if delay:
+                    await asyncio.sleep(delay)
+                
+                # Text (JSON) or binary (MessagePack) envelope
                 try:
-                    data = await websocket.receive_text()
+                    message_data = parse_frame(frame)
+                    FRAMES_RECEIVED.inc(message_data["type"])
+                except ValueError as e:
+                    FRAMES_RECEIVED.inc("invalid")
+                    await manager.send_json(conn, {"type": "error", "message": str(e)})
+                    continue
+                
+                # Over-limit pings and typing updates are dropped; messages get a
+                # "throttled" reply so the client can retry after `retry_after`
+                kind = message_data["type"]
+                if kind in LIMITED_EVENTS:
+                    retry_after = await rate_limiter.check(conn.buckets, username, kind)
+                    if retry_after:
+                        if kind == "message":
+                            await manager.send_json(conn, {
+                                "type": "throttled",
+                                "event": kind,
+                                "retry_after": round(retry_after, 3),
+                            })
+                        continue
+
+                # Handle ping/pong
+                if message_data.get("type") == "ping":
+                    manager.send(conn, PONG_FRAME)
+                    continue
+                elif message_data.get("type") == "pong":
+                    continue
+
+                # Client missed a presence delta and needs the full list again
+                if message_data.get("type") == "presence_sync":
+                    manager.send(conn, manager.presence_snapshot(room))
+                    continue
+                
+                # Handle typing status
+                if message_data.get("type") == "typing":
+                    is_typing = message_data.get("typing", False)
+                    await manager.user_typing(username, is_typing, room)
+                    continue
+
+                # Handle regular messages
+                if message_data.get("type") == "message":
+                    # Get the actual message content, image, and sticker flag
+                    message_content = message_data.get("message", "")
+                    message_image = message_data.get("image", "")
+                    is_sticker = message_data.get("isSticker", False)
                     
-                    # Parse JSON data
-                    message_data = None
-                    try:
-                        message_data = json.loads(data)
-                    except json.JSONDecodeError:
-                        # If not JSON, treat as plain text message
-                        message_data = {"type": "message", "message": data}
+                    # Validate: must have either message or image
+                    if (not message_content or not message_content.strip()) and not message_image:
+                        continue  # Skip empty messages
                     
-                    # Handle ping/pong
-                    if message_data.get("type") == "ping":
-                        await websocket.send_json({"type": "pong"})
-                        continue
-                    elif message_data.get("type") == "pong":
-                        continue
+                    # Limit message length (e.g., 1000 characters)
+                    if message_content and len(message_content) > 1000:
+                        message_content = message_content[:1000]
                     
-                    # Handle typing status
-                    if message_data.get("type") == "typing":
-                        is_typing = message_data.get("typing", False)
-                        await manager.user_typing(username, is_typing)
-                        continue
-
-                    # Handle regular messages
-                    if message_data.get("type") == "message":
-                        # Get the actual message content, image, and sticker flag
-                        message_content = message_data.get("message", "")
-                        message_image = message_data.get("image", "")
-                        is_sticker = message_data.get("isSticker", False)
-                        
-                        # Validate: must have either message or image
-                        if (not message_content or not message_content.strip()) and not message_image:
-                            continue  # Skip empty messages
-                        
-                        # Limit message length (e.g., 1000 characters)
-                        if message_content and len(message_content) > 1000:
-                            message_content = message_content[:1000]
-                        
-                        # Limit image size (base64 can be large, but we'll store it)
-                        # In production, you might want to save images to disk and store URLs
-                        if message_image and len(message_image) > 5 * 1024 * 1024:  # 5MB limit
-                            await websocket.send_json({
+                    # Only a blob reference is stored and broadcast, never the image bytes
+                    if message_image:
+                        try:
+                            message_image = await resolve_image(message_image)
+                        except ValueError as e:
+                            await manager.send_json(conn, {
                                 "type": "error",
-                                "message": "Rasm hajmi juda katta"
+                                "message": str(e)
                             })
                             continue
-                        
-                        # Save message to database
-                        new_msg = Message(
-                            username=username,
-                            content=message_content if message_content else None,
-                            image=message_image if message_image else None
-                        )
-                        db.add(new_msg)
-                        await db.commit()
-                        await db.refresh(new_msg)
-
-                        # Reset typing status when message is sent
-                        await manager.user_typing(username, False)
-
-                        # Broadcast to all users
-                        broadcast_data = {
-                            "type": "message",
-                            "username": username,
-                            "timestamp": new_msg.created_at.isoformat()
-                        }
-                        if message_content:
-                            broadcast_data["message"] = message_content
-                        if message_image:
-                            broadcast_data["image"] = message_image
-                        if is_sticker:
-                            broadcast_data["isSticker"] = True
-                        
-                        await manager.broadcast_json(broadcast_data)
                     
-                except WebSocketDisconnect:
-                    break
-                except Exception:
-                    break  # Handle any other errors by closing connection
-        finally:
-            # Close database session
-            await db.close()
+                    # Id and timestamp are assigned in-process; the row is written
+                    # now (sync mode) or by the background batch flusher
+                    new_msg = await manager.writer.create(
+                        username,
+                        message_content if message_content else None,
+                        message_image if message_image else None,
+                        room
+                    )
+                    await manager.writer.submit(new_msg)
+
+                    # Reset typing status when message is sent
+                    await manager.user_typing(username, False, room)
+
+                    # Broadcast to the room and record in the history cache
+                    await manager.broadcast_json(
+                        message_payload(new_msg, is_sticker=bool(is_sticker)),
+                        history=True,
+                        room=room
+                    )
+                    MESSAGES_ACCEPTED.inc()
+                
+            except WebSocketDisconnect:
+                break
+            except Exception:
+                ERRORS.inc("receive_loop")
+                break  # Handle any other errors by closing connection
                 
     except Exception as e:
         # If connection setup fails, ensure cleanup
-        if websocket in manager.active_connections:
-            manager.disconnect(websocket)
+        if conn is not None:
+            manager.disconnect(conn)
         # Re-raise unexpected exceptions
         if not isinstance(e, (WebSocketDisconnect, ConnectionResetError)):
             raise
     finally:
-        # Always try to clean up and notify others
-        if websocket in manager.active_connections:
-            left_user = manager.disconnect(websocket)
+        # Always clean up; presence reports the leave with the next delta.
+        # Clear the typing indicator once the user's last tab is gone.
+        if conn is not None and manager.disconnect(conn) and username not in manager.room_users.get(room, ()):
             try:
-                await manager.broadcast(f"🔴 {left_user} chatdan chiqdi")
+                await manager.user_typing(username, False, room)
             except Exception:
-                pass  # Ignore broadcast errors during cleanup
+                ERRORS.inc("disconnect_cleanup")
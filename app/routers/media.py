@@ -0,0 +1,129 @@
+import asyncio
+import os
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import FileResponse, Response
+from app.core.blobs import (
+    IMAGE_TYPES,
+    MAX_IMAGE_BYTES,
+    blob_path,
+    blob_url,
+    parse_name,
+    save_blob,
+)
+from app.core.deps import get_current_username
+from app.core.images import create_variants, variant_url
+from app.core.metrics import ERRORS
+
+router = APIRouter(prefix="/media", tags=["Media"])
+
+# Blobs are content-addressed, so a given URL never changes
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+@router.post("", status_code=status.HTTP_201_CREATED)
+async def upload_image(request: Request, username: str = Depends(get_current_username)):
+    """Upload raw image bytes (request body) and return the blob URL."""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail="Rasm hajmi juda katta")
+
+    # Read the body incrementally so oversized uploads are rejected early
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_IMAGE_BYTES:
+            raise HTTPException(status_code=413, detail="Rasm hajmi juda katta")
+        chunks.append(chunk)
+    if not size:
+        raise HTTPException(status_code=400, detail="Bo'sh fayl")
+
+    try:
+        name = await asyncio.to_thread(save_blob, b"".join(chunks))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        await create_variants(name)
+    except Exception:
+        ERRORS.inc("image_variants")  # Undecodable or unsupported image: serve the original only
+    return {
+        "url": blob_url(name),
+        "thumb": variant_url(name, "thumb"),
+        "preview": variant_url(name, "preview"),
+    }
+
+
+def _parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """Parse a single `bytes=start-end` range into inclusive (start, end).
+
+    Returns None for a header to ignore (malformed, another unit or several
+    ranges), which is answered with the whole file. Raises ValueError for a
+    valid range that lies outside the file.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    start_s, _, end_s = spec.strip().partition("-")
+    if not (start_s or end_s) or not all(part.isdigit() for part in (start_s, end_s) if part):
+        return None
+    if start_s:
+        start = int(start_s)
+        end = int(end_s) if end_s else size - 1
+        if end_s and end < start:
+            return None  # Invalid range syntax
+    else:
+        # Suffix range: last N bytes
+        length = int(end_s)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        start, end = max(size - length, 0), size - 1
+    if start >= size:
+        raise ValueError("Range starts past the end of the file")
+    return start, min(end, size - 1)
+
+
+def _read_slice(path: str, start: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(length)
+
+
+@router.get("/{name}")
+async def get_image(name: str, request: Request):
+    """Serve a stored image with ETag and single byte-range support."""
+    parsed = parse_name(name)
+    path = blob_path(name) if parsed else None
+    if not path or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Not found")
+
+    ext = parsed[2]
+    etag = f'"{name.partition(".")[0]}"'
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    media_type = IMAGE_TYPES[ext]
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in if_none_match):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        size = os.path.getsize(path)
+        try:
+            byte_range = _parse_range(range_header, size)
+        except ValueError:
+            return Response(
+                status_code=416,
+                headers={**headers, "Content-Range": f"bytes */{size}"},
+            )
+        if byte_range is not None:
+            start, end = byte_range
+            data = await asyncio.to_thread(_read_slice, path, start, end - start + 1)
+            return Response(
+                content=data,
+                status_code=206,
+                media_type=media_type,
+                headers={**headers, "Content-Range": f"bytes {start}-{end}/{size}"},
+            )
+
+    return FileResponse(path, media_type=media_type, headers=headers)
@@ -0,0 +1,16 @@
+import hmac
+from fastapi import APIRouter, Header, HTTPException, status
+from fastapi.responses import PlainTextResponse
+from app.core.metrics import METRICS_TOKEN, render
+
+router = APIRouter(tags=["Metrics"])
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics(authorization: str | None = Header(default=None)):
+    """Prometheus scrape endpoint. Requires `Authorization: Bearer <METRICS_TOKEN>` when it is set."""
+    if METRICS_TOKEN:
+        expected = f"Bearer {METRICS_TOKEN}"
+        if authorization is None or not hmac.compare_digest(authorization, expected):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4; charset=utf-8")
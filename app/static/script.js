@@ -1,8 +1,9 @@
 // Global variables
 let ws = null;
-let typingTimer = null;
 let typingDebounceTimer = null;
 let isTyping = false;
+let lastTypingSent = 0;
+let lastMessageId = null;  // Resume cursor: id of the newest message rendered
 const messageSound = new Audio("data:audio/mp3;base64,SUQzBAAAAAAAI1RTU0UAAAAPAAADTGF2ZjU4Ljc2LjEwMAAAAAAAAAAAAAAA/+M4wAAAAAAAAAAAAEluZm8AAAAPAAAAEAAABVgANTU1NTU1Q0NDQ0NDUFBQUFBQXl5eXl5ea2tra2tra3l5eXl5eYaGhoaGhpSUlJSUlKGhoaGhoaGvr6+vr6+8vLy8vLzKysrKysrY2NjY2Njm5ubm5ub09PT09PT///////////8AAAAATGF2YzU4LjEzAAAAAAAAAAAAAAAAJAAAAAAAAAAABVjMmLsL/+RYxAAAAANIAAAAAExBTUUzLjEwMFVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVV/+MYxDsAAANIAAAAAFVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVV/+MYxHYAAANIAAAAAFVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVV/+MYxLEAAANIAAAAAFVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVVV");
 
 // Utility functions
@@ -69,6 +70,59 @@ function openImageModal(imageSrc) {
     });
 }
 
+// Inflate a deflate (zlib) compressed binary frame into text
+async function inflateFrame(buffer) {
+    const stream = new Blob([buffer]).stream().pipeThrough(new DecompressionStream("deflate"));
+    return await new Response(stream).text();
+}
+
+// Build the DOM element for a chat message
+function renderMessage(data, username) {
+    const messageDiv = document.createElement("div");
+    messageDiv.className = `message ${data.username === username ? "sent" : "received"}`;
+
+    let messageHTML = `
+        <div class="message-content">
+            <span class="username">${data.username}</span>
+    `;
+
+    // Add image if present
+    if (data.image) {
+        // Thumbnail inline, original only when opened
+        messageHTML += `<img src="${data.image}" alt="Rasm" class="message-image" loading="lazy" onclick="openImageModal('${data.imageFull || data.image}')" />`;
+    }
+
+    // Add sticker if present (display larger)
+    if (data.isSticker && data.message) {
+        messageHTML += `<div class="message-sticker">${data.message}</div>`;
+    } else if (data.message) {
+        // Add regular message text
+        messageHTML += `<p>${escapeHtml(data.message)}</p>`;
+    }
+
+    messageHTML += `
+            <span class="time">${new Date(data.timestamp).toLocaleTimeString()}</span>
+        </div>
+    `;
+
+    messageDiv.innerHTML = messageHTML;
+    return messageDiv;
+}
+
+// Build a system notice line (joins, leaves)
+function renderNotice(text) {
+    const noticeDiv = document.createElement("div");
+    noticeDiv.className = "message received";
+    noticeDiv.innerHTML = `
+        <div class="message-content">
+            <span class="username">System</span>
+            <p>${escapeHtml(text)}</p>
+            <span class="time">${new Date().toLocaleTimeString()}</span>
+        </div>
+    `;
+    return noticeDiv;
+}
+
 // Auth functions
 async function registerUser() {
     console.log("Register function called");
@@ -154,8 +208,27 @@ async function loginUser() {
     }
 }
 
+// Exchange the access token for a short-lived WebSocket connect ticket
+async function fetchWsTicket() {
+    const token = localStorage.getItem("access_token");
+    try {
+        const res = await fetch("/auth/ws-ticket", {
+            method: "POST",
+            headers: { "Authorization": `Bearer ${token}` }
+        });
+        if (res.ok) {
+            const data = await res.json();
+            return data.ticket;
+        }
+    } catch (e) {
+        console.error("Ticket olishda xatolik:", e);
+    }
+    // Older servers or a network hiccup: fall back to the access token
+    return token;
+}
+
 // Chat functions
-function connectWebSocket(username) {
+async function connectWebSocket(username) {
     console.log("Connecting WebSocket for user:", username);
     const chatContainer = document.getElementById("chat-box");
     const loginContainer = document.getElementById("login-container");
@@ -193,42 +266,112 @@ function connectWebSocket(username) {
         }
     }, 100);
 
-    // Connect to WebSocket
-    const token = localStorage.getItem("access_token");
+    // Room comes from the page URL (?room=...), the default room otherwise
+    const room = new URLSearchParams(window.location.search).get("room") || "general";
+
+    // Connect to WebSocket with a fresh ticket, so the access token never appears in the URL
+    const ticket = await fetchWsTicket();
     const wsProtocol = window.location.protocol === "https:" ? "wss:" : "ws:";
-    ws = new WebSocket(`${wsProtocol}//${window.location.host}/ws/${token}`);
+    // Ask for a compressed history batch when the browser can inflate it
+    const params = new URLSearchParams();
+    if (typeof DecompressionStream !== "undefined") params.set("compress", "deflate");
+    // After a drop, only ask for the messages we missed
+    if (lastMessageId !== null) params.set("since", lastMessageId);
+    const query = params.toString() ? `?${params}` : "";
+    ws = new WebSocket(`${wsProtocol}//${window.location.host}/ws/${encodeURIComponent(room)}/${ticket}${query}`);
+    ws.binaryType = "arraybuffer";
+
+    // The server pings us when we are silent, so some frame arrives at least every
+    // heartbeat interval; a longer silence means the connection is dead
+    let lastFrameAt = Date.now();
+    let watchdog;
+    // Set by the server's "reconnect" hint when it is draining for a deploy
+    let reconnectAfter = null;
+
+    // Infinite scroll: page older messages from the REST API when reaching the top
+    let oldestMessageId = null;
+    let hasOlderMessages = false;
+    let loadingOlder = false;
+    const scroller = messagesContainer.parentElement;
+
+    // Presence: full snapshot on connect, then versioned deltas
+    let presenceVersion = null;
+    let onlineSet = new Set();
+
+    function renderOnlineUsers() {
+        onlineUsers.innerHTML = [...onlineSet]
+            .filter(user => user !== username)
+            .map(user => `<span class="online-user"> ${escapeHtml(user)}</span>`)
+            .join("");
+    }
 
-    let pingInterval;
+    async function loadOlderMessages() {
+        if (loadingOlder || !hasOlderMessages || oldestMessageId === null) return;
+        loadingOlder = true;
+        try {
+            const res = await fetch(`/messages?room=${encodeURIComponent(room)}&before=${oldestMessageId}&limit=50`, {
+                headers: { "Authorization": `Bearer ${localStorage.getItem("access_token")}` }
+            });
+            if (!res.ok) throw new Error("Eski xabarlarni yuklashda xatolik");
+            const page = await res.json();
+            if (page.messages.length) {
+                const fragment = document.createDocumentFragment();
+                page.messages.forEach(msg => fragment.appendChild(renderMessage(msg, username)));
+                // Keep the viewport anchored on the message the user was looking at
+                const previousHeight = scroller.scrollHeight;
+                messagesContainer.insertBefore(fragment, messagesContainer.firstChild);
+                scroller.scrollTop += scroller.scrollHeight - previousHeight;
+                oldestMessageId = page.messages[0].id;
+            }
+            hasOlderMessages = page.next_before !== null;
+        } catch (e) {
+            console.error(e);
+        } finally {
+            loadingOlder = false;
+        }
+    }
+
+    scroller.onscroll = () => {
+        if (scroller.scrollTop < 50) {
+            loadOlderMessages();
+        }
+    };
 
     ws.onopen = () => {
         console.log("WebSocket ulanish o'rnatildi");
         showError("Chatga ulandingiz!", "success");
         
-        // Start sending ping messages every 30 seconds
-        pingInterval = setInterval(() => {
-            if (ws && ws.readyState === WebSocket.OPEN) {
-                ws.send(JSON.stringify({ type: "ping" }));
+        lastFrameAt = Date.now();
+        watchdog = setInterval(() => {
+            if (Date.now() - lastFrameAt > 90000) {
+                ws.close();
             }
-        }, 30000);
+        }, 10000);
     };
 
-    ws.onclose = () => {
+    ws.onclose = (event) => {
         console.log("WebSocket ulanish uzildi");
         showError("Chat bilan aloqa uzildi");
         chatContainer.classList.add("hidden");
         loginContainer.classList.remove("hidden");
         
-        // Clear ping interval
-        if (pingInterval) {
-            clearInterval(pingInterval);
+        if (watchdog) {
+            clearInterval(watchdog);
         }
         
-        // Try to reconnect after 5 seconds
+        // Reconnect when the server said to; after a restart (1012) without a
+        // hint, pick a random delay so clients do not all come back at once
+        let delay = 5000;
+        if (reconnectAfter !== null) {
+            delay = reconnectAfter;
+        } else if (event.code === 1012) {
+            delay = 1000 + Math.random() * 9000;
+        }
         setTimeout(() => {
             if (document.visibilityState === "visible") {
                 connectWebSocket(username);
             }
-        }, 5000);
+        }, delay);
     };
 
     ws.onerror = (error) => {
@@ -236,76 +379,110 @@ function connectWebSocket(username) {
         showError("Chatga ulanishda xatolik yuz berdi");
     };
 
+    // Frames are handled one at a time in arrival order; inflating a binary
+    // frame is async and must not let the frames after it overtake it
+    let frameQueue = Promise.resolve();
     ws.onmessage = (event) => {
-        console.log("Raw message received:", event.data);
+        lastFrameAt = Date.now();
+        frameQueue = frameQueue.then(() => handleFrame(event)).catch(console.error);
+    };
+
+    const handleFrame = async (event) => {
+        // Binary frames are deflate-compressed JSON (e.g. large history batches)
+        const text = typeof event.data === "string" ? event.data : await inflateFrame(event.data);
+        console.log("Raw message received:", text);
         try {
-            const data = JSON.parse(event.data);
+            const data = JSON.parse(text);
             console.log("Parsed message:", data);
 
             switch (data.type) {
                 case "ping":
-                    ws.send(JSON.stringify({ type: "pong" }));
+                    // Heartbeat from the server; the server matches this exact text
+                    ws.send('{"type":"pong"}');
                     break;
                 
                 case "message":
                     console.log("Message received:", data);
-                    const messageDiv = document.createElement("div");
-                    messageDiv.className = `message ${data.username === username ? "sent" : "received"}`;
-                    
-                    let messageHTML = `
-                        <div class="message-content">
-                            <span class="username">${data.username}</span>
-                    `;
-                    
-                    // Add image if present
-                    if (data.image) {
-                        messageHTML += `<img src="${data.image}" alt="Rasm" class="message-image" onclick="openImageModal('${data.image}')" />`;
-                    }
-                    
-                    // Add sticker if present (display larger)
-                    if (data.isSticker && data.message) {
-                        messageHTML += `<div class="message-sticker">${data.message}</div>`;
-                    } else if (data.message) {
-                        // Add regular message text
-                        messageHTML += `<p>${escapeHtml(data.message)}</p>`;
-                    }
-                    
-                    messageHTML += `
-                            <span class="time">${new Date(data.timestamp).toLocaleTimeString()}</span>
-                        </div>
-                    `;
-                    
-                    messageDiv.innerHTML = messageHTML;
-                    messagesContainer.appendChild(messageDiv);
+                    messagesContainer.appendChild(renderMessage(data, username));
                     messagesContainer.scrollTop = messagesContainer.scrollHeight;
+                    lastMessageId = data.id;
                     if (data.username !== username) {
                         messageSound.play().catch(console.error);
                     }
                     break;
 
-                case "online_users":
-                    onlineUsers.innerHTML = data.users
-                        .filter(user => user !== username)
-                        .map(user => `<span class="online-user"> ${user}</span>`)
-                        .join("");
+                case "history": {
+                    // Whole backlog arrives in one frame: build it off-DOM and insert once
+                    const fragment = document.createDocumentFragment();
+                    data.messages.forEach(msg => fragment.appendChild(renderMessage(msg, username)));
+                    messagesContainer.appendChild(fragment);
+                    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+                    oldestMessageId = data.messages.length ? data.messages[0].id : null;
+                    hasOlderMessages = oldestMessageId !== null;
+                    lastMessageId = data.messages.length ? data.messages[data.messages.length - 1].id : null;
                     break;
+                }
+
+                case "resume": {
+                    // Only the messages missed while disconnected
+                    const fragment = document.createDocumentFragment();
+                    data.messages.forEach(msg => fragment.appendChild(renderMessage(msg, username)));
+                    messagesContainer.appendChild(fragment);
+                    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+                    if (data.messages.length) lastMessageId = data.messages[data.messages.length - 1].id;
+                    break;
+                }
 
-                case "typing":
-                    // Only show typing indicator for other users, not for current user
-                    if (data.username && data.username !== username) {
-                        if (data.is_typing) {
-                            typingIndicator.textContent = `${data.username} yozmoqda...`;
-                            clearTimeout(typingTimer);
-                            typingTimer = setTimeout(() => {
-                                typingIndicator.textContent = "";
-                            }, 3000); // Show for 3 seconds
-                        } else {
-                            // Clear typing indicator when user stops typing
-                            typingIndicator.textContent = "";
-                            clearTimeout(typingTimer);
-                        }
+                case "resync":
+                    // Too far behind: drop what we have, a full history frame follows
+                    messagesContainer.innerHTML = "";
+                    lastMessageId = null;
+                    break;
+
+                case "presence_snapshot":
+                    onlineSet = new Set(data.users);
+                    presenceVersion = data.version;
+                    renderOnlineUsers();
+                    break;
+
+                case "presence":
+                    if (presenceVersion === null) break;  // Snapshot not received yet
+                    if (data.version !== presenceVersion + 1) {
+                        // Missed a delta: ask for a fresh snapshot
+                        presenceVersion = null;
+                        ws.send(JSON.stringify({ type: "presence_sync" }));
+                        break;
                     }
+                    presenceVersion = data.version;
+                    data.joined.forEach(user => {
+                        onlineSet.add(user);
+                        if (user !== username) messagesContainer.appendChild(renderNotice(`🔵 ${user} chatga qo'shildi`));
+                    });
+                    data.left.forEach(user => {
+                        onlineSet.delete(user);
+                        if (user !== username) messagesContainer.appendChild(renderNotice(`🔴 ${user} chatdan chiqdi`));
+                    });
+                    renderOnlineUsers();
+                    messagesContainer.scrollTop = messagesContainer.scrollHeight;
                     break;
+
+                case "reconnect":
+                    // Server is restarting: it closes the socket next
+                    reconnectAfter = data.after_ms;
+                    break;
+
+                case "throttled":
+                    // Sent too fast: the message was not delivered
+                    messagesContainer.appendChild(renderNotice(`⏳ Juda tez yuboryapsiz, ${Math.ceil(data.retry_after)} soniyadan keyin qayta urinib ko'ring`));
+                    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+                    break;
+
+                case "typing": {
+                    // Snapshot of everyone typing in the room; the server expires stale entries
+                    const typers = data.users.filter(user => user !== username);
+                    typingIndicator.textContent = typers.length ? `${typers.join(", ")} yozmoqda...` : "";
+                    break;
+                }
                     
                 default:
                     console.log("Unknown message type:", data.type);
@@ -319,7 +496,7 @@ function connectWebSocket(username) {
             messageDiv.innerHTML = `
                 <div class="message-content">
                     <span class="username">System</span>
-                    <p>${event.data}</p>
+                    <p>${text}</p>
                     <span class="time">${new Date().toLocaleTimeString()}</span>
                 </div>
             `;
@@ -341,10 +518,12 @@ function connectWebSocket(username) {
             }
             sendMessage();
         } else {
-            // Send typing status with debounce
-            if (!isTyping) {
+            // Send typing status with debounce, refreshed every 2 seconds
+            // so the server does not expire it while the user keeps typing
+            if (!isTyping || Date.now() - lastTypingSent > 2000) {
                 ws.send(JSON.stringify({ type: "typing", typing: true }));
                 isTyping = true;
+                lastTypingSent = Date.now();
             }
             
             // Clear existing debounce timer
@@ -672,21 +851,32 @@ function initFileUpload() {
             return;
         }
         
-        // Convert to base64
-        const reader = new FileReader();
-        reader.onload = (event) => {
-            const base64Image = event.target.result;
-            // Send image as message
+        // Upload the raw file, then send only its URL over the WebSocket
+        try {
+            const res = await fetch("/media", {
+                method: "POST",
+                headers: {
+                    "Content-Type": file.type,
+                    "Authorization": `Bearer ${localStorage.getItem("access_token")}`
+                },
+                body: file
+            });
+            const data = await res.json();
+            if (!res.ok) {
+                throw new Error(data.detail || "Rasm yuklashda xatolik");
+            }
             if (ws && ws.readyState === WebSocket.OPEN) {
                 ws.send(JSON.stringify({
                     type: "message",
                     message: "",
-                    image: base64Image
+                    image: data.url
                 }));
-                fileInput.value = ""; // Reset input
             }
-        };
-        reader.readAsDataURL(file);
+        } catch (err) {
+            showError(err.message || "Rasm yuklashda xatolik");
+        } finally {
+            fileInput.value = ""; // Reset input
+        }
     });
 }
 
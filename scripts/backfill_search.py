@@ -0,0 +1,33 @@
+"""Create the full-text search index for an existing database and fill it.
+
+On SQLite this creates the FTS5 table and its sync triggers, then rebuilds the
+index from every existing message in one bulk pass. On Postgres it creates the
+GIN index, which indexes existing rows as it is built.
+
+Run with:
+    python -m scripts.backfill_search
+"""
+
+import asyncio
+from sqlalchemy import text
+
+from app.core.database import engine
+from app.core.search import POSTGRES_DDL, SQLITE_DDL, SQLITE_REBUILD
+
+
+async def backfill():
+    async with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            for statement in POSTGRES_DDL:
+                await conn.execute(text(statement))
+        else:
+            for statement in SQLITE_DDL:
+                await conn.execute(text(statement))
+            await conn.execute(text(SQLITE_REBUILD))
+        count = (await conn.execute(text("SELECT COUNT(*) FROM messages"))).scalar()
+    await engine.dispose()
+    print(f"Search index ready for {count} messages.")
+
+
+if __name__ == "__main__":
+    asyncio.run(backfill())
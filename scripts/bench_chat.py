@@ -0,0 +1,389 @@
+"""Load and latency benchmark for the WebSocket chat path.
+
+Starts the app on a temporary database (or targets --url), logs in a pool of
+users, opens many WebSocket clients spread over rooms and drives message,
+typing and reconnect workloads. Results are printed as JSON (or written with
+--output) so runs can be compared over time.
+
+Run with:
+    python -m scripts.bench_chat --clients 1000 --rooms 20 --duration 15
+
+The server started here has the RATE_* limits switched off unless they are set
+in the environment; a server given with --url keeps its own.
+
+Reported:
+    connect    - connect-storm wall time and per-client connect latency
+    messages   - end-to-end delivery latency percentiles, sent and delivered msgs/sec,
+                 and messages the server rejected as over a rate limit (throttled)
+    reconnect  - reconnect-storm wall time and latency
+    server     - CPU and RSS of the server process (only when started here)
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import websockets
+
+BENCH_PREFIX = "bench|"
+# Rate limits of app/core/ratelimit.py; empty disables them on the benchmark server
+RATE_LIMIT_VARS = (
+    "RATE_FRAME_CONNECTION",
+    "RATE_MESSAGE_CONNECTION", "RATE_TYPING_CONNECTION", "RATE_PING_CONNECTION",
+    "RATE_MESSAGE_USER", "RATE_TYPING_USER", "RATE_PING_USER",
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="Target a running server (e.g. http://127.0.0.1:8000) instead of starting one")
+    parser.add_argument("--port", type=int, default=8799, help="Port for the server started by the benchmark")
+    parser.add_argument("--server-arg", action="append", default=[], help="Extra uvicorn argument (repeatable)")
+    parser.add_argument("--clients", type=int, default=200, help="WebSocket clients to open")
+    parser.add_argument("--users", type=int, default=50, help="Distinct accounts shared by the clients")
+    parser.add_argument("--rooms", type=int, default=1, help="Rooms the clients are spread over")
+    parser.add_argument("--senders", type=int, default=None, help="Clients that send messages (default 10%%)")
+    parser.add_argument("--rate", type=float, default=1.0, help="Messages per second per sender")
+    parser.add_argument("--typing-rate", type=float, default=0.0, help="Typing events per second per sender")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of message traffic")
+    parser.add_argument("--reconnect", type=int, default=None, help="Clients dropped and reconnected at the end (default 50%%)")
+    parser.add_argument("--concurrency", type=int, default=200, help="Connects in flight at once")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    return parser.parse_args()
+
+
+def percentiles(samples: list[float]) -> dict:
+    """Summary of latency samples in milliseconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": pick(0.50),
+        "p90_ms": pick(0.90),
+        "p99_ms": pick(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def raise_fd_limit(needed: int):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+
+# --- Server process -----------------------------------------------------------
+
+def start_server(port: int, extra_args: list[str]) -> tuple[subprocess.Popen, str]:
+    """Start uvicorn on a fresh temporary database and wait until it answers."""
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite+aiosqlite:///{workdir}/chat.db",
+        MEDIA_DIR=f"{workdir}/media",
+        SALT_ROUNDS=os.environ.get("SALT_ROUNDS", "4"),  # Logins are not what we measure
+    )
+    for name in RATE_LIMIT_VARS:
+        env.setdefault(name, "")
+    subprocess.run([sys.executable, "-m", "app.core.init_db"], env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port),
+         "--log-level", "warning", *extra_args],
+        env=env,
+    )
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base + "/docs", timeout=1)
+            return process, base
+        except (urllib.error.URLError, ConnectionError):
+            if process.poll() is not None:
+                raise RuntimeError("Server exited during startup")
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("Server did not start within 30 seconds")
+
+
+class ResourceSampler:
+    """Samples CPU time and RSS of a process from /proc (Linux) every interval."""
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.cpu_samples: list[float] = []
+        self.rss_samples: list[int] = []
+        self._task: asyncio.Task | None = None
+
+    def _read(self) -> tuple[float, int] | None:
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{self.pid}/statm") as f:
+                pages = int(f.read().split()[1])
+        except OSError:
+            return None
+        ticks = os.sysconf("SC_CLK_TCK")
+        cpu = (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+        return cpu, pages * os.sysconf("SC_PAGE_SIZE")
+
+    async def _run(self):
+        previous = self._read()
+        last = time.monotonic()
+        while previous is not None:
+            await asyncio.sleep(self.interval)
+            current = self._read()
+            now = time.monotonic()
+            if current is None:
+                break
+            self.cpu_samples.append((current[0] - previous[0]) / (now - last) * 100)
+            self.rss_samples.append(current[1])
+            previous, last = current, now
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> dict:
+        if self._task is not None:
+            self._task.cancel()
+        if not self.cpu_samples:
+            return {}
+        return {
+            "cpu_percent_mean": round(statistics.fmean(self.cpu_samples), 1),
+            "cpu_percent_max": round(max(self.cpu_samples), 1),
+            "rss_mb_max": round(max(self.rss_samples) / 2**20, 1),
+            "rss_mb_last": round(self.rss_samples[-1] / 2**20, 1),
+        }
+
+
+# --- HTTP helpers ---------------------------------------------------------------
+
+def post(base: str, path: str, body: dict) -> dict:
+    request = urllib.request.Request(
+        base + path, data=json.dumps(body).encode(), headers={"Content-Type": "application/json"}
+    )
+    try:
+        return json.loads(urllib.request.urlopen(request, timeout=30).read())
+    except urllib.error.HTTPError as e:
+        return {"status": e.code}
+
+
+def login(base: str, username: str) -> str:
+    post(base, "/auth/register", {"username": username, "password": "bench-password"})
+    data = post(base, "/auth/login", {"username": username, "password": "bench-password"})
+    if "access_token" not in data:
+        raise RuntimeError(f"Login failed for {username}: {data}")
+    return data["access_token"]
+
+
+# --- Clients --------------------------------------------------------------------
+
+class Stats:
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.sent = 0
+        self.delivered = 0
+        self.throttled = 0  # Sent messages the server refused with a "throttled" reply
+        self.recording = False
+
+
+class Client:
+    def __init__(self, index: int, ws_base: str, room: str, token: str, stats: Stats):
+        self.index = index
+        self.url = f"{ws_base}/ws/{room}/{token}"
+        self.stats = stats
+        self.ws = None
+        self._reader: asyncio.Task | None = None
+
+    async def connect(self) -> float:
+        """Open the socket and wait for the history frame. Returns the connect latency."""
+        started = time.perf_counter()
+        self.ws = await websockets.connect(self.url, max_size=None, open_timeout=60)
+        await self.ws.recv()  # History batch
+        elapsed = time.perf_counter() - started
+        self._reader = asyncio.create_task(self._read())
+        return elapsed
+
+    async def _read(self):
+        stats = self.stats
+        try:
+            async for frame in self.ws:
+                if frame == '{"type":"ping"}':
+                    await self.ws.send('{"type":"pong"}')  # Heartbeat, or long runs get reaped
+                    continue
+                if not isinstance(frame, str):
+                    continue
+                if frame.startswith('{"type":"throttled"'):
+                    if stats.recording:
+                        stats.throttled += 1
+                    continue
+                if not frame.startswith('{"type":"message"'):
+                    continue
+                text = json.loads(frame).get("message", "")
+                if stats.recording and text.startswith(BENCH_PREFIX):
+                    stats.latencies.append(time.perf_counter() - float(text.split("|")[2]))
+                    stats.delivered += 1
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send_messages(self, rate: float, typing_rate: float, until: float):
+        """Send timestamped messages (and typing events) at the given rates."""
+        loop = asyncio.get_running_loop()
+        next_message = loop.time() + random.random() / rate
+        next_typing = loop.time() + random.random() / typing_rate if typing_rate else float("inf")
+        seq = 0
+        while True:
+            wake = min(next_message, next_typing)
+            if wake >= until:
+                break
+            await asyncio.sleep(max(0.0, wake - loop.time()))
+            if wake == next_typing:
+                await self.ws.send('{"type":"typing","typing":true}')
+                next_typing += 1 / typing_rate
+                continue
+            seq += 1
+            text = f"{BENCH_PREFIX}{self.index}:{seq}|{time.perf_counter()!r}"
+            await self.ws.send(json.dumps({"type": "message", "message": text}))
+            self.stats.sent += 1
+            next_message += 1 / rate
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self._reader is not None:
+            await self._reader
+
+
+async def connect_all(clients: list[Client], concurrency: int) -> dict:
+    """Open every client with bounded concurrency; report the storm."""
+    gate = asyncio.Semaphore(concurrency)
+    latencies, failures = [], 0
+
+    async def one(client):
+        nonlocal failures
+        async with gate:
+            try:
+                latencies.append(await client.connect())
+            except Exception:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(client) for client in clients))
+    wall = time.perf_counter() - started
+    return {
+        "clients": len(clients),
+        "failed": failures,
+        "wall_seconds": round(wall, 3),
+        "connects_per_second": round(len(latencies) / wall, 1) if wall else None,
+        "latency": percentiles(latencies),
+    }
+
+
+async def run(args) -> dict:
+    process = None
+    base = args.url.rstrip("/") if args.url else None
+    if base is None:
+        process, base = start_server(args.port, args.server_arg)
+    ws_base = "ws" + base[len("http"):]
+    sampler = ResourceSampler(process.pid) if process is not None else None
+    raise_fd_limit(args.clients * 2 + 256)
+
+    try:
+        # Accounts (bcrypt is slow on purpose, so log in from a thread pool)
+        users = [f"bench{i}" for i in range(min(args.users, args.clients))]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            tokens = list(pool.map(lambda username: login(base, username), users))
+        login_seconds = time.perf_counter() - started
+
+        if sampler is not None:
+            sampler.start()
+
+        stats = Stats()
+        clients = [
+            Client(i, ws_base, f"bench-{i % args.rooms}", tokens[i % len(tokens)], stats)
+            for i in range(args.clients)
+        ]
+        report = {"connect": await connect_all(clients, args.concurrency)}
+        connected = [client for client in clients if client.ws is not None]
+
+        # Steady-state message traffic
+        senders = connected[:args.senders if args.senders is not None else max(1, len(connected) // 10)]
+        await asyncio.sleep(1)  # Let presence and history traffic settle
+        loop = asyncio.get_running_loop()
+        stats.recording = True
+        started = loop.time()
+        until = started + args.duration
+        await asyncio.gather(*(s.send_messages(args.rate, args.typing_rate, until) for s in senders))
+        await asyncio.sleep(2)  # Drain in-flight deliveries
+        stats.recording = False
+        elapsed = loop.time() - started
+        report["messages"] = {
+            "senders": len(senders),
+            "sent": stats.sent,
+            "delivered": stats.delivered,
+            "throttled": stats.throttled,
+            "sent_per_second": round(stats.sent / args.duration, 1),
+            "delivered_per_second": round(stats.delivered / elapsed, 1),
+            "latency": percentiles(stats.latencies),
+        }
+
+        # Reconnect storm: drop a share of the clients and bring them back at once
+        count = args.reconnect if args.reconnect is not None else len(connected) // 2
+        dropped = connected[:count]
+        await asyncio.gather(*(client.close() for client in dropped))
+        report["reconnect"] = await connect_all(dropped, args.concurrency)
+
+        await asyncio.gather(*(client.close() for client in clients if client.ws is not None),
+                             return_exceptions=True)
+        report["server"] = sampler.stop() if sampler is not None else {}
+        report["login_seconds"] = round(login_seconds, 3)
+        return report
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parse_args()
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": git_revision(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        **asyncio.run(run(args)),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
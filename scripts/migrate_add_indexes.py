@@ -0,0 +1,45 @@
+"""Migration script to add the messages pagination index.
+
+Run with:
+    python scripts/migrate_add_indexes.py
+"""
+
+import sqlite3
+import os
+
+# Database path
+db_path = "chat.db"
+
+INDEXES = {
+    "ix_messages_created_at_id": "CREATE INDEX ix_messages_created_at_id ON messages (created_at, id)",
+}
+
+def migrate():
+    """Create missing indexes on the messages table."""
+    if not os.path.exists(db_path):
+        print(f"Database {db_path} not found. Please run init_db first.")
+        return
+    
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("PRAGMA index_list(messages)")
+        existing = {row[1] for row in cursor.fetchall()}
+        
+        for name, ddl in INDEXES.items():
+            if name in existing:
+                print(f"Index '{name}' already exists.")
+                continue
+            cursor.execute(ddl)
+            print(f"Created index '{name}'.")
+        conn.commit()
+        
+    except sqlite3.Error as e:
+        print(f"Error during migration: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    migrate()
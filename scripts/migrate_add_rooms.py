@@ -0,0 +1,55 @@
+"""Migration script to add the room_id column to messages.
+
+Existing messages are moved into the default room.
+
+Run with:
+    python scripts/migrate_add_rooms.py
+"""
+
+import sqlite3
+import os
+
+# Database path
+db_path = "chat.db"
+
+DEFAULT_ROOM = "general"
+
+def migrate():
+    """Add room_id column and its index to messages table if they don't exist."""
+    if not os.path.exists(db_path):
+        print(f"Database {db_path} not found. Please run init_db first.")
+        return
+    
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("PRAGMA table_info(messages)")
+        columns = [column[1] for column in cursor.fetchall()]
+        
+        if 'room_id' not in columns:
+            print("Adding 'room_id' column to messages table...")
+            cursor.execute(
+                f"ALTER TABLE messages ADD COLUMN room_id VARCHAR NOT NULL DEFAULT '{DEFAULT_ROOM}'"
+            )
+            print("Migration completed successfully!")
+        else:
+            print("Column 'room_id' already exists. No migration needed.")
+        
+        cursor.execute("PRAGMA index_list(messages)")
+        existing = {row[1] for row in cursor.fetchall()}
+        if "ix_messages_room_created_at_id" not in existing:
+            cursor.execute(
+                "CREATE INDEX ix_messages_room_created_at_id ON messages (room_id, created_at, id)"
+            )
+            print("Created index 'ix_messages_room_created_at_id'.")
+        conn.commit()
+        
+    except sqlite3.Error as e:
+        print(f"Error during migration: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,64 @@
+"""Migration script to move inline base64 images into the blob store.
+
+Rows whose `image` column holds a `data:image/...;base64,` URL are written to
+MEDIA_DIR and rewritten to reference the blob URL instead.
+
+Run with:
+    python -m scripts.migrate_images_to_blobs
+"""
+
+import sqlite3
+import os
+
+from app.core.blobs import blob_url, decode_data_url, save_blob
+
+# Database path
+db_path = "chat.db"
+
+BATCH_SIZE = 100
+
+
+def migrate():
+    """Rewrite inline images as blob URLs, committing in small batches."""
+    if not os.path.exists(db_path):
+        print(f"Database {db_path} not found. Please run init_db first.")
+        return
+
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    moved = skipped = 0
+    last_id = 0
+
+    try:
+        while True:
+            rows = cursor.execute(
+                "SELECT id, image FROM messages WHERE id > ? AND image LIKE 'data:%' "
+                "ORDER BY id LIMIT ?",
+                (last_id, BATCH_SIZE),
+            ).fetchall()
+            if not rows:
+                break
+
+            for message_id, image in rows:
+                last_id = message_id
+                try:
+                    url = blob_url(save_blob(decode_data_url(image)))
+                except ValueError as e:
+                    print(f"Skipping message {message_id}: {e}")
+                    skipped += 1
+                    continue
+                cursor.execute("UPDATE messages SET image = ? WHERE id = ?", (url, message_id))
+                moved += 1
+            conn.commit()
+
+        print(f"Moved {moved} images into the blob store, skipped {skipped}.")
+
+    except sqlite3.Error as e:
+        print(f"Error during migration: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    migrate()
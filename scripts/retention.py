@@ -0,0 +1,50 @@
+"""Run one message retention pass now, using the RETENTION_* settings.
+
+Run with:
+    python -m scripts.retention
+
+Options:
+    --enable-incremental-vacuum  switch an existing SQLite database to
+                                 auto_vacuum=INCREMENTAL (runs a full VACUUM
+                                 once; stop the server first)
+    --vacuum-pages N             free pages to return to the filesystem
+"""
+
+import argparse
+import asyncio
+from sqlalchemy import text
+
+from app.core.database import engine, read_engine
+from app.core.retention import RETENTION_VACUUM_PAGES, incremental_vacuum, run_once
+
+
+async def enable_incremental_vacuum():
+    if engine.dialect.name != "sqlite":
+        print("Only SQLite databases need this.")
+        return
+    # VACUUM cannot run inside a transaction
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+        await conn.execute(text("VACUUM"))
+        mode = (await conn.execute(text("PRAGMA auto_vacuum"))).scalar()
+    print("auto_vacuum is now INCREMENTAL." if mode == 2 else f"auto_vacuum is {mode}; conversion failed.")
+
+
+async def main(args):
+    if args.enable_incremental_vacuum:
+        await enable_incremental_vacuum()
+    removed = await run_once()
+    print(f"Removed {removed} messages.")
+    await incremental_vacuum(args.vacuum_pages)
+    await engine.dispose()
+    await read_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply message retention limits once")
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="Convert an existing SQLite database to incremental auto-vacuum")
+    parser.add_argument("--vacuum-pages", type=int, default=RETENTION_VACUUM_PAGES,
+                        help="Free pages to return to the filesystem after the pass")
+    asyncio.run(main(parser.parse_args()))